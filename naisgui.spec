@@ -9,7 +9,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    hiddenimports=['httpx', 'h2'],  # optional, imported lazily; skipped with a warning if not installed
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
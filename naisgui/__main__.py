@@ -0,0 +1,37 @@
+import argparse
+import multiprocessing
+import sys
+from naisgui.batch import nais_batch_parser
+from naisgui.bench import nais_bench, nais_bench_parser
+from naisgui.mock import nais_mock, nais_mock_parser
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='naisgui')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('gui', help='start the GUI (default)')
+    batch = commands.add_parser('batch', help='generate images headless, no Qt or display needed')
+    nais_batch_parser(batch)
+    mock = commands.add_parser('mock', help='run a local stand-in for the NovelAI API')
+    mock.add_argument('--host', default='127.0.0.1')
+    mock.add_argument('--port', type=int, default=8000)
+    nais_mock_parser(mock)
+    mock.set_defaults(func=nais_mock)
+    bench = commands.add_parser('bench', help='load test Nais against the local mock server')
+    nais_bench_parser(bench)
+    bench.set_defaults(func=nais_bench)
+    args = parser.parse_args()
+    if args.command in ['batch', 'mock', 'bench']:
+        try:
+            return args.func(args)
+        except (OSError, RuntimeError, ValueError) as e:
+            print(e, file=sys.stderr)
+            return 2
+    # Qt is only imported for the GUI
+    from naisgui.gui import NaisGui
+    NaisGui()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,279 @@
+import asyncio
+import binascii
+import json
+import os
+import threading
+import time
+import zipfile
+from naisgui.credentials import NaisCredentials
+from naisgui.limiter import NaisLimiter
+from naisgui.nais import Nais, NaisImageDecoder, nais_access_key
+from naisgui.retry import *
+from naisgui.transport import _httpx_error
+from naisgui.util import json_to_text, payload_digest, text_to_json
+
+
+class AsyncNais():
+    def __init__(self, nais: Nais = None, concurrency: int = None, http2: bool = None):
+        # Same surface as Nais on one event loop, needs "httpx"; settings, credentials, retry policy,
+        # index and thumbnails are shared with the synchronous client so both can be used side by side
+        import httpx
+        self._httpx = httpx
+        self.nais = nais or Nais()
+        self.settings = self.nais.settings
+        self.retry = self.nais.retry
+        self.metrics = self.nais.metrics
+        self.concurrency = concurrency or self.settings['concurrency']
+        self.limiter = NaisLimiter(self.settings['rate'], self.settings['burst'], self.settings['rate_min'],
+                                   self.settings['rate_max'], 1, self.concurrency,
+                                   self.settings['latency_tolerance'], self.settings['limiter'])
+        limits = httpx.Limits(max_connections=self.concurrency + 1, max_keepalive_connections=self.concurrency + 1)
+        self._client = httpx.AsyncClient(http2=self.settings['http2'] if http2 is None else http2, limits=limits)
+        self._headers = {}
+        self._accessKey = None
+        self._credentialId = None
+        self._login_lock = None
+        self._inflight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def _set_token(self, token: str):
+        # The synchronous client gets the token too
+        self._headers['Authorization'] = f'Bearer {token}'
+        self.nais._headers['Authorization'] = f'Bearer {token}'
+
+    async def login(self, email: str, password: str):
+        self._credentialId = NaisCredentials.id(email) if self.settings['credentials_cache'] else None
+        entry = self.nais.credentials.load(self._credentialId) if self._credentialId else None
+        if entry:
+            self._accessKey = entry['key']
+            if NaisCredentials.valid(entry):
+                self._set_token(entry['token'])
+                print('logged in. (cached)')
+                return
+            try:
+                await self.relogin()
+                print('logged in.')
+                return
+            except NaisError as e:
+                print(e)
+                self.nais.credentials.forget(self._credentialId)
+        # argon2 takes a while, keep it off the loop
+        loop = asyncio.get_running_loop()
+        self._accessKey = await loop.run_in_executor(None, nais_access_key, email, password)
+        await self.relogin()
+        print('logged in.')
+
+    async def relogin(self):
+        resp = await self.post('/user/login', {"key": self._accessKey})
+        if resp.status_code not in [200, 201]:
+            raise NaisError(f'Login failed! {resp.status_code}', resp.status_code)
+        token = json.loads(resp.content.decode('utf-8'))['accessToken']
+        self._set_token(token)
+        if self._credentialId:
+            self.nais.credentials.save(self._credentialId, self._accessKey, token)
+
+    async def _relogin_once(self, stale: str):
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if self._headers.get('Authorization') == stale:
+                await self.relogin()
+
+    async def post(self, url, args, **kwargs):
+        kwargs.update({
+            'timeout': self.settings['timeout'],
+            'json' if type(args) is dict else 'content': args,
+        })
+        try:
+            return await self._client.post(self.settings['root'] + url, headers=self._headers, **kwargs)
+        except self._httpx.TransportError as e:
+            raise _httpx_error(self._httpx, e) from e
+
+    async def _acquire(self):
+        while True:
+            wait = self.limiter.poll()
+            if wait is None:
+                return
+            await asyncio.sleep(wait or 0.05)
+
+    async def gen_image(self, args):
+        if type(args) is str:
+            args = text_to_json(args)
+        await self._acquire()
+        t = time.monotonic()
+        latency = None
+        throttled = False
+        try:
+            try:
+                async with self._client.stream('POST', self.settings['root'] + '/ai/generate-image', json=args,
+                                               headers=self._headers, timeout=self.settings['timeout']) as resp:
+                    if resp.status_code not in [200, 201]:
+                        throttled = resp.status_code in [429, 503]
+                        await resp.aread()
+                        raise NaisError(f'Bad Response! {resp.status_code} {resp.text[:256]}', resp.status_code,
+                                        parse_retry_after(resp.headers.get('Retry-After')))
+                    decoder = NaisImageDecoder(int(resp.headers.get('Content-Length') or 0))
+                    try:
+                        async for chunk in resp.aiter_bytes(1 << 16):
+                            decoder.feed(chunk)
+                            if decoder.done:
+                                break
+                        data = decoder.finish()
+                    except (binascii.Error, zipfile.BadZipFile, RuntimeError) as e:
+                        raise NaisError(f'Broken Response! {e}')
+            except self._httpx.TransportError as e:
+                raise _httpx_error(self._httpx, e) from e
+            latency = time.monotonic() - t
+            self.metrics.timings['network'].record(latency - decoder.seconds)
+            self.metrics.timings['decode'].record(decoder.seconds)
+            return data
+        finally:
+            self.limiter.release(latency, throttled)
+
+    async def request_image(self, name, args):
+        base = os.path.join(self.nais.output_folder(), name)
+        with open(f'{base}.json', 'wt', encoding='utf-8') as f:
+            f.write(json_to_text(args))
+        t = time.monotonic()
+        im_bin = await self.gen_image(args)
+        self.nais.pipeline.stats['request'].record(time.monotonic() - t)
+        return name, args, im_bin
+
+    def _write(self, item: tuple):
+        with self.nais.pipeline.stats['write'].measure():
+            return self.nais.write_image(*item)
+
+    async def write_image(self, name, args, im_bin):
+        # PNG splicing, the index and thumbnails are blocking, they run on the default executor
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._write, (name, args, im_bin))
+
+    async def save_image(self, name, args):
+        if type(args) is str:
+            try:
+                args = text_to_json(args)
+            except Exception as e:
+                print(e)
+                return
+        return await self.write_image(*await self.request_image(name, args))
+
+    async def job_save_image(self, name: str, text, cache: bool = True):
+        args = text
+        if type(args) is str:
+            try:
+                args = text_to_json(args)
+            except Exception as e:
+                print(e)
+                return None
+        if cache and self.settings['result_cache']:
+            # Duplicates in flight at the same time wait for the first one's image instead of requesting it too
+            digest = payload_digest(args)
+            while digest in self._inflight:
+                await self._inflight[digest].wait()
+            loop = asyncio.get_running_loop()
+            self._inflight[digest] = asyncio.Event()
+            try:
+                hit = await loop.run_in_executor(None, self.nais.reuse_image, name, args, digest)
+                if hit is not None:
+                    self.metrics.count('cached')
+                    return name
+                return await self._request_and_write(name, args)
+            finally:
+                self._inflight.pop(digest).set()
+        return await self._request_and_write(name, args)
+
+    async def _request_and_write(self, name: str, args: dict):
+        record = self.retry.record(name)
+        while record.attempts < self.retry.attempts:
+            record.attempts += 1
+            auth = self._headers.get('Authorization')
+            try:
+                item = await self.request_image(name, args)
+            except Exception as e:
+                print(e)
+                self.retry.failed(record, e)
+                action = self.retry.classify(e)
+                if action == NAIS_RETRY_NEVER:
+                    self.metrics.count('failure')
+                    return None
+                self.metrics.count('retry')
+                if action == NAIS_RETRY_LOGIN:
+                    try:
+                        await self._relogin_once(auth)
+                    except Exception as e:
+                        print(e)
+                        self.metrics.count('failure')
+                        return None
+                    continue
+                await asyncio.sleep(self.retry.delay(record.attempts - 1, e))
+                continue
+            record.ok = True
+            self.metrics.count('success')
+            try:
+                return await self.write_image(*item)
+            except Exception as e:
+                print(e)
+                return None
+        self.metrics.count('failure')
+        return None
+
+    async def generate(self, payloads, concurrency: int = None):
+        # Yields saved image names in completion order; the workers share one payload iterator so
+        # a lazy sweep is only expanded as fast as requests go out
+        payloads = iter(payloads)
+        results = asyncio.Queue()
+
+        async def worker():
+            try:
+                for args in payloads:
+                    name = await self.job_save_image(self.nais.new_image_name(), args)
+                    if name is not None:
+                        results.put_nowait(name)
+            finally:
+                results.put_nowait(None)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency or self.concurrency)]
+        try:
+            running = len(workers)
+            while running:
+                name = await results.get()
+                if name is None:
+                    running -= 1
+                    continue
+                yield name
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+class NaisAsyncLoop():
+    def __init__(self):
+        # One event loop on one background thread for Qt: coroutines are submitted from the GUI thread
+        # and results come back through callbacks, which can emit queued signals
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def iterate(self, agen, on_item: callable):
+        return self.submit(self._drain(agen, on_item))
+
+    @staticmethod
+    async def _drain(agen, on_item: callable):
+        async for item in agen:
+            on_item(item)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
@@ -0,0 +1,185 @@
+import argparse
+import getpass
+import json
+import os
+import sys
+import threading
+import time
+from hashlib import blake2b
+from naisgui.nais import Nais
+from naisgui.sweep import NaisSweep
+from naisgui.tweak import NaisTweak
+from naisgui.util import NaisJob, read_text, text_to_json
+
+
+class NaisProgress():
+    def __init__(self, total: int, done: int = 0, stream=None):
+        self._stream = stream or sys.stderr
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._shown = 0.0
+        self._skipped = done
+        self.total = total
+        self.done = done
+        self.failed = 0
+
+    def update(self, ok: bool = True):
+        with self._lock:
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+            self._show()
+
+    def _show(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._shown < 0.1:
+            return
+        self._shown = now
+        finished = self.done + self.failed
+        width = 30
+        fill = int(width * finished / self.total) if self.total else width
+        rate = (finished - self._skipped) / (now - self._start) if now > self._start else 0.0
+        eta = (self.total - finished) / rate if rate > 0.0 else 0.0
+        self._stream.write(f'\r[{"#" * fill}{"." * (width - fill)}] {finished}/{self.total}'
+                           f' {self.failed} failed {rate * 60.0:.1f}/min ETA {int(eta) // 60}:{int(eta) % 60:02d} ')
+        self._stream.flush()
+
+    def close(self):
+        with self._lock:
+            self._show(True)
+            self._stream.write('\n')
+
+
+class NaisBatchState():
+    def __init__(self, path: str, key: str, total: int, restart: bool = False):
+        # Append-only: a header line, then one line per saved image, so a killed run loses nothing
+        self._lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(path) and not restart:
+            with open(path, 'rt', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+            header = json.loads(lines[0]) if lines else {}
+            if header.get('batch') != key:
+                raise RuntimeError(f'{path} belongs to another batch, use --restart to discard it')
+            for line in lines[1:]:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from a crash
+                    continue
+                self.done[entry['i']] = entry['name']
+            self._file = open(path, 'at', encoding='utf-8')
+        else:
+            self._file = open(path, 'wt', encoding='utf-8')
+            self._write({'batch': key, 'total': total})
+
+    def _write(self, entry: dict):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+
+    def add(self, i: int, name: str):
+        with self._lock:
+            self.done[i] = name
+            self._write({'i': i, 'name': name})
+
+    def close(self):
+        self._file.close()
+
+
+def nais_batch_key(*parts):
+    h = blake2b(digest_size=16, person=b'naisgui-batch')
+    for part in parts:
+        h.update(part.encode() + b'\0')
+    return h.hexdigest()
+
+
+def nais_batch_payloads(args):
+    text = read_text(args.data)
+    if args.sweep:
+        spec = args.sweep if args.sweep.lstrip().startswith('{') else read_text(args.sweep)
+        key = nais_batch_key(text, 'sweep', spec)
+        spec = json.loads(spec)
+        # Without an explicit seed the order and random seeds follow the batch, so a rerun resumes the same plan
+        spec.setdefault('seed', int(key[:8], 16))
+        plan = NaisSweep(text_to_json(text), spec)
+        if plan.dropped:
+            print(f'sweep: {len(plan)} images, {plan.dropped} duplicates dropped', file=sys.stderr)
+        return key, len(plan), plan.payload
+    script = read_text(args.tweak) if args.tweak else ''
+    tweak = NaisTweak(text, script)
+    n = args.repeat
+    return nais_batch_key(text, script, str(n)), n, lambda i: tweak.render(n, i)
+
+
+def nais_batch(args):
+    # The state file already makes batches resumable
+    settings = {'concurrency': args.concurrency, 'journal': False, 'result_cache': not args.no_cache}
+    if args.output:
+        settings['output_folder'] = args.output
+    if args.root:
+        settings['root'] = args.root
+    nais = Nais(settings)
+    if not args.no_cache:
+        nais.index.refresh()
+    key, num, render = nais_batch_payloads(args)
+    state = NaisBatchState(args.state or os.path.join(nais.output_folder(), 'batch-state.jsonl'), key, num,
+                           args.restart)
+
+    email = args.email or os.environ.get('NAI_USERNAME') or input('Email: ')
+    password = os.environ.get('NAI_PASSWORD') or getpass.getpass('Password: ')
+    nais.login(email, password)
+
+    progress = NaisProgress(num, len(state.done))
+
+    def task(i: int):
+        # Rendered here rather than by the queue, a script error fails only this image
+        try:
+            args = render(i)
+        except Exception as e:
+            print(f'\npayload {i}: {e}', file=sys.stderr)
+            progress.update(False)
+            return
+
+        def saved(name):
+            state.add(i, name)
+            progress.update()
+        if not nais.job_save_image(nais.new_image_name(), args, saved):
+            progress.update(False)
+
+    tasks = (lambda i=i: task(i) for i in range(num) if i not in state.done)
+    job = NaisJob(args.concurrency, on_wait=nais.metrics.timings['queue'].record)
+    job.start()
+    try:
+        job.extend(0, tasks, num - len(state.done))
+        job.join()
+        nais.pipeline.flush()
+    except KeyboardInterrupt:
+        job.cancel(0)
+        print('\ninterrupted, rerun the same command to resume', file=sys.stderr)
+    finally:
+        job.stop()
+        progress.close()
+        state.close()
+        if args.metrics:
+            nais.metrics.export(args.metrics)
+    return 0 if progress.failed == 0 and len(state.done) == num else 1
+
+
+def nais_batch_parser(parser: argparse.ArgumentParser):
+    parser.add_argument('data', help='prompt data JSON, as in the GUI prompt editor')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('-n', '--repeat', type=int, default=1, help='number of images, the tweak script sees N and I')
+    mode.add_argument('--sweep', help='variation sweep spec, JSON text or file: '
+                                      '{"sampler": [...], "scale": {"from": 7, "to": 12, "step": 0.5}, '
+                                      '"repeat": 2, "random_seed": true, "order": "interleaved"}')
+    parser.add_argument('-t', '--tweak', help='tweak script file')
+    parser.add_argument('-j', '--concurrency', type=int, default=2)
+    parser.add_argument('-o', '--output', help='output folder')
+    parser.add_argument('--state', help='state file, defaults to batch-state.jsonl in the output folder')
+    parser.add_argument('--restart', action='store_true', help='discard the state file of another batch')
+    parser.add_argument('--email', help='defaults to NAI_USERNAME, the password is read from NAI_PASSWORD or asked')
+    parser.add_argument('--root', help='API root URL')
+    parser.add_argument('--no-cache', action='store_true', help='request every payload even if its image exists')
+    parser.add_argument('--metrics', help='write timings and counts to this .json or .csv file at the end')
+    parser.set_defaults(func=nais_batch)
@@ -0,0 +1,129 @@
+import concurrent.futures
+import json
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from naisgui.mock import nais_mock_parser, nais_mock_server
+from naisgui.util import NaisJob
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+NAIS_BENCH_PAYLOAD = {
+    'input': 'masterpiece, best quality, benchmark',
+    'model': 'safe-diffusion',
+    'parameters': {
+        'width': 512, 'height': 768, 'scale': 11, 'sampler': 'k_euler_ancestral', 'steps': 28, 'seed': 0,
+        'n_samples': 1, 'ucPreset': 0, 'qualityToggle': True, 'uc': '',
+    },
+}
+
+
+def peak_rss():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def _bench_level(root: str, concurrency: int, images: int, width: int, height: int):
+    # Runs in a fresh process so the peak RSS belongs to this level alone
+    from naisgui.nais import Nais
+    folder = tempfile.mkdtemp(prefix='naisbench-')
+    try:
+        nais = Nais({'root': root, 'output_folder': folder, 'concurrency': concurrency, 'limiter': False,
+                     'credentials_cache': False, 'journal': False, 'retry_base': 0.05, 'retry_cap': 1.0})
+        nais.login('bench@localhost', 'bench')
+        lock = threading.Lock()
+        latencies = []
+        failed = []
+
+        def task(i: int):
+            args = json.loads(json.dumps(NAIS_BENCH_PAYLOAD))
+            args['parameters'].update({'seed': i, 'width': width, 'height': height})
+            t = time.monotonic()
+
+            def saved(name):
+                with lock:
+                    latencies.append(time.monotonic() - t)
+            if not nais.job_save_image(nais.new_image_name(), args, saved):
+                with lock:
+                    failed.append(i)
+
+        job = NaisJob(concurrency, on_wait=nais.metrics.timings['queue'].record)
+        job.start()
+        t = time.monotonic()
+        job.extend(0, (lambda i=i: task(i) for i in range(images)), images)
+        job.join()
+        nais.pipeline.flush()
+        elapsed = time.monotonic() - t
+        job.stop()
+        return {
+            'concurrency': concurrency,
+            'images': len(latencies),
+            'failed': len(failed),
+            'seconds': elapsed,
+            'images_per_sec': len(latencies) / elapsed if elapsed > 0.0 else 0.0,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'retries': sum(nais.retry.counts.values()),
+            'peak_rss': peak_rss(),
+            'metrics': nais.metrics.snapshot(),
+        }
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def nais_bench_report(results: list):
+    lines = [f'{"conc":>5} {"images":>7} {"failed":>7} {"img/s":>8} {"p50 s":>7} {"p99 s":>7} {"retries":>8}'
+             f' {"peak RSS":>10}']
+    for r in results:
+        rss = f'{r["peak_rss"] / (1 << 20):.1f} MiB' if r['peak_rss'] else '-'
+        lines.append(f'{r["concurrency"]:>5} {r["images"]:>7} {r["failed"]:>7} {r["images_per_sec"]:>8.2f}'
+                     f' {r["p50"]:>7.3f} {r["p99"]:>7.3f} {r["retries"]:>8} {rss:>10}')
+    return '\n'.join(lines)
+
+
+def nais_bench(args):
+    mock = nais_mock_server(args)
+    root = mock.start()
+    results = []
+    try:
+        ctx = multiprocessing.get_context('spawn')
+        for concurrency in args.concurrency:
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx) as pool:
+                r = pool.submit(_bench_level, root, concurrency, args.images, args.width, args.height).result()
+            r['server_peak'] = mock.peak
+            mock.peak = 0
+            results.append(r)
+            print(f'concurrency {concurrency}: {r["images_per_sec"]:.2f} img/s', file=sys.stderr)
+    finally:
+        mock.stop()
+    print(nais_bench_report(results))
+    if args.json:
+        with open(args.json, 'wt', encoding='utf-8') as f:
+            json.dump({'server': mock.counts, 'results': results}, f, indent=2)
+    return 0 if all(r['failed'] == 0 for r in results) else 1
+
+
+def nais_bench_parser(parser):
+    parser.add_argument('-c', '--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('-n', '--images', type=int, default=40, help='images per concurrency level')
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--height', type=int, default=768)
+    parser.add_argument('--json', help='also write the results to this file for comparing runs')
+    nais_mock_parser(parser)
@@ -0,0 +1,83 @@
+import base64
+import json
+import os
+import threading
+import time
+from hashlib import blake2b
+
+
+NAIS_CREDENTIALS_VERSION = 2
+
+
+def nais_config_folder():
+    base = os.environ.get('APPDATA') or os.environ.get('XDG_CONFIG_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.config')
+    return os.path.join(base, 'naisgui')
+
+
+def token_expiry(token: str):
+    # The access token is a JWT, only the exp claim is read, nothing is verified here
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class NaisCredentials():
+    def __init__(self, path: str = None):
+        # Entries are keyed by a hash of the email alone, a password hash here would only let anyone reading
+        # the file test guesses cheaply; the file holds the derived access key and the bearer token and is
+        # created user-only. A key that stops working is forgotten and derived again on login
+        self._path = path or os.path.join(nais_config_folder(), 'credentials.json')
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def id(email: str):
+        h = blake2b(digest_size=32, person=b'naisgui-email')
+        h.update(email.encode())
+        return h.hexdigest()
+
+    def _read(self):
+        # Files of older versions are ignored and replaced on the next write
+        try:
+            with open(self._path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        if data.get('version') != NAIS_CREDENTIALS_VERSION:
+            return {}
+        return data.get('entries', {})
+
+    def _write(self, entries: dict):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp = self._path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wt', encoding='utf-8') as f:
+            json.dump({'version': NAIS_CREDENTIALS_VERSION, 'entries': entries}, f)
+        os.replace(tmp, self._path)
+
+    def load(self, cid: str):
+        with self._lock:
+            return self._read().get(cid)
+
+    def save(self, cid: str, key: str, token: str = None):
+        with self._lock:
+            entries = self._read()
+            entries[cid] = {'key': key, 'token': token, 'expires': token_expiry(token) if token else None}
+            self._write(entries)
+
+    def forget(self, cid: str):
+        with self._lock:
+            entries = self._read()
+            if entries.pop(cid, None) is not None:
+                self._write(entries)
+
+    @staticmethod
+    def valid(entry: dict, margin: float = 300.0):
+        if not entry or not entry.get('token'):
+            return False
+        # A token without an exp claim can't be trusted to still work
+        expires = entry.get('expires')
+        return expires is not None and expires - margin > time.time()
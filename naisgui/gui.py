@@ -1,44 +1,155 @@
+import collections
 import copy
 import datetime
 import random
 import send2trash
 import sys
+from naisgui.importer import nais_import
+from naisgui.metrics import NAIS_TIMINGS
 from naisgui.nais import *
+from naisgui.sweep import NAIS_SWEEP_ORDERS, NaisSweep
+from naisgui.tweak import NaisTweak, NaisTweakPreview
 from naisgui.util import *
+from naisgui.widgets import *
 from PySide2.QtCore import *
 from PySide2.QtGui import *
 from PySide2.QtWidgets import *
 from PIL.ImageQt import ImageQt
 
 
-g_nais = Nais()
-g_job = NaisJob()
+class GuiJobStatus(QObject):
+    jobStatusChanged = Signal(int, int, str)
+
+
+# Created by NaisGui, not at import: spawned import workers import this module too and must not
+# open the index, thumbnails and journal of the running app
+g_nais = None
+g_job_status = None
+g_job = None
 
 JOB_CHANNEL_MAIN = 0
 JOB_CHANNEL_VARIATIONS = 1
 JOB_CHANNEL_REGENERATION = 2
+JOB_CHANNEL_IMPORT = 3
+
 
+def job_cancel(ch: int):
+    g_job.cancel(ch)
+    if g_nais.journal is not None:
+        g_nais.journal.cancel(ch)
 
-def create_list_widget_item(name: str):
-    base = os.path.join(g_nais.output_folder(), name)
-    try:
-        data = text_to_json(read_text(base + '.json'))
-    except json.JSONDecodeError as e:
-        print(e)
-        return
-    item = QListWidgetItem()
-    item.setIcon(QIcon(base + '_tm.png'))
-    item.setData(Qt.UserRole + 0, name)
-    item.setData(Qt.UserRole + 1, data)
-    return item
+
+class GuiImageModel(QAbstractListModel):
+    thumbnailReady = Signal(str)
+
+    def __init__(self, maxThumbnails: int = 1024):
+        super().__init__()
+        # Rows are just names, metadata stays in the index and thumbnails are loaded when the view asks for them
+        self._all = []
+        self._names = []
+        self._filter = None
+        self._thumbnails = collections.OrderedDict()
+        self._maxThumbnails = maxThumbnails
+        self._repaint = QTimer(self)
+        self._repaint.setSingleShot(True)
+        self._repaint.setInterval(50)
+        self._repaint.timeout.connect(self.on_repaint)
+        self.thumbnailReady.connect(self.on_thumbnail_ready)
+        g_nais.thumbnails.subscribe(self.thumbnailReady.emit)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        name = self._names[index.row()]
+        if role == Qt.DecorationRole:
+            return self.thumbnail(name)
+        if role == Qt.UserRole + 0:
+            return name
+        if role == Qt.UserRole + 1:
+            return g_nais.index.get(name)
+        return None
+
+    def thumbnail(self, name: str):
+        pm = self._thumbnails.get(name)
+        if pm is not None:
+            self._thumbnails.move_to_end(name)
+            return pm
+        data = g_nais.thumbnails.get(name)
+        if data is None:
+            g_nais.thumbnails.request(name)
+            return None
+        pm = QPixmap()
+        pm.loadFromData(data, 'PNG')
+        self._thumbnails[name] = pm
+        if len(self._thumbnails) > self._maxThumbnails:
+            self._thumbnails.popitem(last=False)
+        return pm
+
+    def on_thumbnail_ready(self, name: str):
+        self._thumbnails.pop(name, None)
+        if not self._repaint.isActive():
+            self._repaint.start()
+
+    def on_repaint(self):
+        # Thumbnails arrive in bursts, one repaint of the visible rows covers all of them
+        if self._names:
+            self.dataChanged.emit(self.index(0), self.index(len(self._names) - 1), [Qt.DecorationRole])
+
+    def name(self, row: int):
+        return self._names[row]
+
+    def setNames(self, names):
+        self.beginResetModel()
+        self._all = list(names)
+        self._names = self._filtered()
+        self._thumbnails.clear()
+        self.endResetModel()
+
+    def setFilter(self, names: set):
+        # None shows every row, otherwise only the names in the set
+        self.beginResetModel()
+        self._filter = names
+        self._names = self._filtered()
+        self.endResetModel()
+
+    def _filtered(self):
+        if self._filter is None:
+            return list(self._all)
+        return [n for n in self._all if n in self._filter]
+
+    def append(self, name: str, visible: bool = True):
+        self._all.append(name)
+        if not visible:
+            return
+        row = len(self._names)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._names.append(name)
+        self.endInsertRows()
+
+    def removeRowsAt(self, rows):
+        removed = set()
+        for row in sorted(set(rows), reverse=True):
+            self.beginRemoveRows(QModelIndex(), row, row)
+            removed.add(self._names.pop(row))
+            self.endRemoveRows()
+        for name in removed:
+            self._thumbnails.pop(name, None)
+        self._all = [n for n in self._all if n not in removed]
 
 
 class GuiFromToStep(QWidget):
+    changed = Signal()
+
     def __init__(self, SpinBoxType):
         super().__init__()
         self.fr = SpinBoxType()
         self.to = SpinBoxType()
         self.step = SpinBoxType()
+        for box in [self.fr, self.to, self.step]:
+            box.valueChanged.connect(lambda _: self.changed.emit())
         layout = QHBoxLayout()
         layout.setMargin(0)
         layout.setContentsMargins(0, 0, 0, 0)
@@ -63,14 +174,8 @@ class GuiFromToStep(QWidget):
         self.fr.setValue(value)
         self.to.setValue(value)
 
-    def range(self):
-        i = self.fr.value()
-        n = self.to.value()
-        s = self.step.value()
-        if s > 0.0:
-            while i <= n:
-                yield i
-                i += s
+    def spec(self):
+        return {'from': self.fr.value(), 'to': self.to.value(), 'step': self.step.value()}
 
 
 class GuiImageVariations(QWidget):
@@ -100,14 +205,27 @@ class GuiImageVariations(QWidget):
             QCheckBox('plms'),
             QCheckBox('ddim')]
         self._randomSeed = QCheckBox()
+        self._reuse = QCheckBox()
+        self._reuse.setChecked(True)
+        self._reuse.setToolTip('Take images of identical payloads from disk instead of requesting them again')
         self._uc = QPlainTextEdit()
         self._repeat = QSpinBox()
         self._repeat.setSuffix(' Times')
         self._repeat.setMinimum(1)
+        self._order = QComboBox()
+        self._order.addItems(NAIS_SWEEP_ORDERS)
+        self._order.setToolTip('grid: nested loops, interleaved: cover every value early, random: shuffled')
+        self._plan = QLabel()
         self._buttonStart = QPushButton('Start')
         self._buttonStart.pressed.connect(self.generate)
         self._buttonStop = QPushButton('Stop')
-        self._buttonStop.pressed.connect(lambda: g_job.cancel(JOB_CHANNEL_VARIATIONS))
+        self._buttonStop.pressed.connect(lambda: job_cancel(JOB_CHANNEL_VARIATIONS))
+        for smp in self._samplers:
+            smp.toggled.connect(self.update_plan)
+        self._scale.changed.connect(self.update_plan)
+        self._step.changed.connect(self.update_plan)
+        self._randomSeed.toggled.connect(self.update_plan)
+        self._repeat.valueChanged.connect(self.update_plan)
         smplayout = QVBoxLayout()
         for smp in self._samplers:
             smplayout.addWidget(smp)
@@ -118,8 +236,11 @@ class GuiImageVariations(QWidget):
         layout.addRow('Scale:', self._scale)
         layout.addRow('Steps:', self._step)
         layout.addRow('Random Seed:', self._randomSeed)
+        layout.addRow('Reuse Results:', self._reuse)
         layout.addRow('UC:', self._uc)
         layout.addRow('Repeat:', self._repeat)
+        layout.addRow('Order:', self._order)
+        layout.addRow('Plan:', self._plan)
         vlayout.addLayout(layout)
         hlayout = QHBoxLayout()
         hlayout.setMargin(0)
@@ -143,39 +264,58 @@ class GuiImageVariations(QWidget):
         except FileNotFoundError as e:
             self._data = {}
             print(e)
-
-    def _job_impl(self, name, text: str):
-        if g_nais.job_save_image(name, text):
-            self.generated.emit(name)
+        self.update_plan()
 
     def gen(self):
+        # Snapshot the widgets here, the payloads are expanded by the job workers
         data = copy.deepcopy(self._data)
         data['input'] = self._input.toPlainText()
         data['parameters']['uc'] = self._uc.toPlainText()
         samplers = [smp.text() for smp in self._samplers if smp.isChecked()]
         if not samplers:
             samplers = [data['parameters']['sampler']]
-        for smp in samplers:
-            data['parameters']['sampler'] = smp
-            for scl in self._scale.range():
-                data['parameters']['scale'] = scl
-                for stp in self._step.range():
-                    data['parameters']['steps'] = stp
-                    for rep in range(self._repeat.value()):
-                        if self._randomSeed.isChecked():
-                            data['parameters']['seed'] = random.randint(0, 4294967295)
-                        yield json_to_text(data)
+        # The seed fixes the order and the random seeds, so a replayed journal asks for the same images
+        spec = {
+            'sampler': samplers,
+            'scale': self._scale.spec(),
+            'steps': self._step.spec(),
+            'repeat': self._repeat.value(),
+            'random_seed': self._randomSeed.isChecked(),
+            'order': self._order.currentText(),
+            'seed': random.randrange(1 << 32),
+        }
+        return data, spec
+
+    def update_plan(self):
+        if not self._data:
+            self._plan.setText('')
+            return
+        plan = NaisSweep(*self.gen())
+        if not plan.count:
+            self._plan.setText('0 images, nothing to generate (is a from larger than its to?)')
+            return
+        text = f'{len(plan)} images'
+        if plan.dropped:
+            text += f', {plan.dropped} duplicates dropped'
+        eta = datetime.timedelta(seconds=round(plan.estimate(g_nais.seconds_per_image(), g_job.concurrency())))
+        self._plan.setText(f'{text}, about {eta}')
 
     def generate(self):
         if not self._data:
             return
-        for x in self.gen():
-            g_job.append(JOB_CHANNEL_VARIATIONS,
-                         lambda _x=x: self._job_impl(datetime.datetime.now().strftime('%Y%m%d%H%M%S'), _x))
+        data, spec = self.gen()
+        num = len(NaisSweep(data, spec))
+        if num == 0:
+            self.update_plan()
+            return
+        params = {'data': data, 'spec': spec, 'cache': self._reuse.isChecked()}
+        num, tasks = g_nais.job_tasks(JOB_CHANNEL_VARIATIONS, 'sweep', params, num, self.generated.emit)
+        g_job.extend(JOB_CHANNEL_VARIATIONS, tasks, num)
 
 
 class GuiData(QWidget):
     textChanged = Signal()
+    importRequested = Signal(list)
 
     def __init__(self):
         super().__init__()
@@ -214,7 +354,12 @@ class GuiData(QWidget):
             event.ignore()
 
     def dropEvent(self, event):
-        url = event.mimeData().urls()[0]
+        urls = event.mimeData().urls()
+        paths = [u.toLocalFile() for u in urls if u.isLocalFile()]
+        if len(urls) > 1 or any(os.path.isdir(p) or p.lower().endswith('.zip') for p in paths):
+            self.importRequested.emit(paths)
+            return
+        url = urls[0]
         if url.isLocalFile():
             src, ret = nais_data_from_local_image(url.toLocalFile())
         else:
@@ -239,11 +384,14 @@ class GuiData(QWidget):
 
 class GuiPrompt(QWidget):
     generated = Signal(str)
+    previewReady = Signal(int, str)
+    importRequested = Signal(list)
 
     def __init__(self):
         super().__init__()
         self.setWindowTitle('Input')
         self._text = GuiData()
+        self._text.importRequested.connect(self.importRequested.emit)
         self._tweak = NaisCodeEditor()
         self._preview = NaisCodeEditor()
         self._preview.setReadOnly(True)
@@ -252,16 +400,20 @@ class GuiPrompt(QWidget):
         self._repeat.setMinimum(1)
         self._repeat.setMaximum(50000)
         self._repeat.setSuffix(' Times')
+        self._reuse = QCheckBox()
+        self._reuse.setChecked(True)
+        self._reuse.setToolTip('Take images of identical payloads from disk instead of requesting them again')
         self._buttonStart = QPushButton('Start')
         self._buttonStart.pressed.connect(self.generate)
         self._buttonStop = QPushButton('Stop')
-        self._buttonStop.pressed.connect(lambda: g_job.cancel(JOB_CHANNEL_MAIN))
+        self._buttonStop.pressed.connect(lambda: job_cancel(JOB_CHANNEL_MAIN))
         layout = QVBoxLayout()
         form = QFormLayout()
         form.addRow('Data:', self._text)
         form.addRow('Tweak:', self._tweak)
         form.addRow('Preview:', self._preview)
         form.addRow('Repeat:', self._repeat)
+        form.addRow('Reuse Results:', self._reuse)
         layout.addLayout(form)
         hlayout = QHBoxLayout()
         hlayout.setMargin(0)
@@ -270,6 +422,13 @@ class GuiPrompt(QWidget):
         hlayout.addWidget(self._buttonStop)
         layout.addLayout(hlayout)
         self.setLayout(layout)
+        self._previewRevision = 0
+        self._previewWorker = NaisTweakPreview(self.previewReady.emit)
+        self._previewTimer = QTimer(self)
+        self._previewTimer.setSingleShot(True)
+        self._previewTimer.setInterval(250)
+        self._previewTimer.timeout.connect(self.update_preview)
+        self.previewReady.connect(self.on_preview_ready)
         self._text.textChanged.connect(self.on_context_changed)
         self._tweak.textChanged.connect(self.on_context_changed)
         self.loadDfaultInput()
@@ -341,46 +500,53 @@ data['parameters']['scale'] = random.choice([4.0, 6.0, 8.0, 10.0, 12.0])
         if fpath:
             self._tweak.setPlainText(read_text(fpath))
 
-    def _job_impl(self, name, text: str):
-        if g_nais.job_save_image(name, text):
-            self.generated.emit(name)
-
     def on_context_changed(self):
-        self._preview.setPlainText(self.gen(self._repeat.value(), 0))
+        self._previewTimer.start()
 
-    def gen(self, N, I):
-        try:
-            data = text_to_json(self._text.toPlainText())
-            exec(self._tweak.toPlainText())
-        except Exception as e:
-            return str(e)
-        try:
-            text = json_to_text(data)
-        except Exception as e:
-            return str(e)
-        return text
+    def update_preview(self):
+        self._previewRevision = self._previewWorker.submit(
+            self._text.toPlainText(), self._tweak.toPlainText(), self._repeat.value(), 0)
+
+    def on_preview_ready(self, revision: int, text: str):
+        if revision == self._previewRevision:
+            self._preview.setPlainText(text)
 
     def generate(self):
+        # Payloads are rendered by the workers from this snapshot, not up front
         n = self._repeat.value()
-        for i in range(n):
-            g_job.append(JOB_CHANNEL_MAIN, lambda x=self.gen(n, i): self._job_impl(datetime.datetime.now().strftime('%Y%m%d%H%M%S'), x))
+        params = {
+            'text': self._text.toPlainText(),
+            'script': self._tweak.toPlainText(),
+            'cache': self._reuse.isChecked(),
+        }
+        try:
+            NaisTweak(params['text'], params['script'])
+        except Exception as e:
+            print(e)
+            return
+        num, tasks = g_nais.job_tasks(JOB_CHANNEL_MAIN, 'tweak', params, n, self.generated.emit)
+        g_job.extend(JOB_CHANNEL_MAIN, tasks, num)
 
     def setText(self, name: str, text: str):
         self._text.setPlainText(text)
 
 
-class GuiArchiveList(QListWidget):
+class GuiArchiveList(QListView):
     generated = Signal(str)
 
     def __init__(self):
         super().__init__()
+        self._model = GuiImageModel()
+        self.setModel(self._model)
         self.setAcceptDrops(False)
         self.setContentsMargins(0, 0, 0, 0)
         self.setSpacing(0)
         self.setIconSize(QSize(32, 32))
-        self.setViewMode(QListWidget.IconMode)
-        self.setResizeMode(QListWidget.ResizeMode.Adjust)
-        self.setSelectionMode(QListWidget.SelectionMode.ExtendedSelection)
+        self.setViewMode(QListView.IconMode)
+        self.setResizeMode(QListView.ResizeMode.Adjust)
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(QListView.Batched)
+        self.setSelectionMode(QListView.SelectionMode.ExtendedSelection)
         self.refresh()
         self.customContextMenuRequested.connect(self.on_custom_menu_requested)
         self.setContextMenuPolicy(Qt.CustomContextMenu)
@@ -399,55 +565,56 @@ class GuiArchiveList(QListWidget):
         menu.exec_(self.mapToGlobal(pos))
 
     def refresh(self):
-        self.clear()
-        for f in os.listdir(g_nais.output_folder()):
-            name = os.path.splitext(f)[0]
-            base = os.path.join(g_nais.output_folder(), name)
-            if not f.endswith('.json'):
-                continue
-            if os.path.exists(base + '.png'):
-                continue
-            item = create_list_widget_item(name)
-            if item is not None:
-                self.addItem(item)
+        g_nais.index.refresh()
+        self._model.setNames(g_nais.index.names(archived=True))
 
     def show_in_explorer(self):
-        item = self.currentItem()
-        if not item:
+        index = self.currentIndex()
+        if not index.isValid():
             return
-        name = item.data(Qt.UserRole + 0)
+        name = index.data(Qt.UserRole + 0)
         path = os.path.join(g_nais.output_folder(), name) + '.png'
         show_in_explorer(path)
 
     def restore_selected_images(self):
-        def _job_impl(name, text: str):
-            if g_nais.job_save_image(name, text):
-                self.generated.emit(name)
-        for item in self.selectedItems():
-            x = item.data(Qt.UserRole)
-            y = json_to_text(item.data(Qt.UserRole + 1))
-            g_job.append(JOB_CHANNEL_VARIATIONS, lambda _x=x, _y=y: _job_impl(_x, _y))
-
+        indexes = self.selectedIndexes()
+        if not indexes:
+            return
+        params = {
+            'payloads': [index.data(Qt.UserRole + 1) for index in indexes],
+            'names': [index.data(Qt.UserRole) for index in indexes],
+        }
+        num, tasks = g_nais.job_tasks(JOB_CHANNEL_VARIATIONS, 'payloads', params, len(indexes), self.generated.emit)
+        g_job.extend(JOB_CHANNEL_VARIATIONS, tasks, num)
 
 
 class GuiImageList(QWidget):
     itemChanged = Signal(str)
     itemArchived = Signal()
+    added = Signal(str)
 
     def __init__(self):
         super().__init__()
         self.setWindowTitle('List')
         self._filter = QLineEdit()
         self._filter.textChanged.connect(self.on_filter_changed)
-        self._list = QListWidget()
+        self.added.connect(self.add)
+        self._filter.setToolTip('Tags separated by commas must all match. '
+                                'Use "a | b" for either, "-tag" to exclude and "tag*" for a prefix. '
+                                'Also uc:tag, sampler:k_euler, seed:1..100, scale:5..11, steps:28')
+        self._model = GuiImageModel()
+        self._list = QListView()
+        self._list.setModel(self._model)
         self._list.setAcceptDrops(False)
         self._list.setContentsMargins(0,0,0,0)
         self._list.setSpacing(0)
         self._list.setIconSize(QSize(64, 64))
-        self._list.setViewMode(QListWidget.IconMode)
-        self._list.setResizeMode(QListWidget.ResizeMode.Adjust)
-        self._list.setSelectionMode(QListWidget.SelectionMode.ExtendedSelection)
-        self._list.itemSelectionChanged.connect(self.on_item_selection_changed)
+        self._list.setViewMode(QListView.IconMode)
+        self._list.setResizeMode(QListView.ResizeMode.Adjust)
+        self._list.setUniformItemSizes(True)
+        self._list.setLayoutMode(QListView.Batched)
+        self._list.setSelectionMode(QListView.SelectionMode.ExtendedSelection)
+        self._list.selectionModel().selectionChanged.connect(self.on_item_selection_changed)
         self._list.customContextMenuRequested.connect(self.on_custom_menu_requested)
         self._list.setContextMenuPolicy(Qt.CustomContextMenu)
         self._list.startDrag = self.startDrag
@@ -471,7 +638,10 @@ class GuiImageList(QWidget):
         self.actionRefresh.triggered.connect(self.refresh)
         self.actionRegenerateSelectedImages = QAction(self)
         self.actionRegenerateSelectedImages.setText('Regenerate Selected Images')
-        self.actionRegenerateSelectedImages.triggered.connect(self.regenerate_selected_images)
+        self.actionRegenerateSelectedImages.triggered.connect(lambda: self.regenerate_selected_images())
+        self.actionRegenerateSelectedImagesUncached = QAction(self)
+        self.actionRegenerateSelectedImagesUncached.setText('Regenerate Selected Images (Skip Cache)')
+        self.actionRegenerateSelectedImagesUncached.triggered.connect(lambda: self.regenerate_selected_images(False))
         layout = QVBoxLayout()
         layout.setContentsMargins(2,2,2,2)
         layout.setMargin(2)
@@ -489,54 +659,53 @@ class GuiImageList(QWidget):
         menu.addAction(self.actionShowInExplorer)
         menu.addAction(self.actionRefresh)
         menu.addAction(self.actionRegenerateSelectedImages)
+        menu.addAction(self.actionRegenerateSelectedImagesUncached)
         menu.addAction(self.actionExportSelectedImages)
         menu.addAction(self.actionArchiveSelectedImages)
         menu.addAction(self.actionDeleteSelectedImages)
         menu.exec_(self._list.mapToGlobal(pos))
 
+    def search(self):
+        text = self._filter.text()
+        if not text.strip():
+            return None
+        try:
+            return g_nais.index.search(text)
+        except Exception:
+            # Half typed queries like "seed:12.." are expected while editing
+            return False
+
     def on_filter_changed(self):
-        tags = self._filter.text().split(',')
-        for i in range(self._list.count() - 1):
-            item = self._list.item(i)
-            data = item.data(Qt.UserRole + 1)
-            input_tags = data['input']
-            hidden = False
-            for t in tags:
-                t = t.strip()
-                if not t:
-                    continue
-                if t not in input_tags:
-                    hidden = True
-                    break
-            item.setHidden(hidden)
+        names = self.search()
+        if names is not False:
+            self._model.setFilter(names)
+
+    def selectedIndexes(self):
+        return self._list.selectionModel().selectedIndexes()
 
     def on_item_selection_changed(self):
-        item = self._list.currentItem()
-        if item is None:
+        index = self._list.currentIndex()
+        if not index.isValid():
             return
-        name = item.data(Qt.UserRole + 0)
+        name = index.data(Qt.UserRole + 0)
         self.itemChanged.emit(name)
 
     def load(self, name: str):
-        base = os.path.join(g_nais.output_folder(), name)
         self.add(name)
 
     def add(self, name: str):
-        item = create_list_widget_item(name)
-        if item is not None:
-            self._list.addItem(item)
+        names = self.search()
+        self._model.append(name, names is None or names is False or name in names)
 
     def refresh(self):
-        self._list.clear()
-        for f in os.listdir(g_nais.output_folder()):
-            if not f.endswith('.json'):
-                continue
-            if not os.path.exists(os.path.join(g_nais.output_folder(), os.path.splitext(f)[0] + '.png')):
-                continue
-            self.load(os.path.splitext(f)[0])
+        g_nais.index.refresh()
+        g_nais.thumbnails.prune(g_nais.index.mtimes())
+        self._model.setNames(g_nais.index.names(archived=False))
+        self.on_filter_changed()
 
     def delete_selected_images(self):
-        for i in self._list.selectedItems():
+        rows = []
+        for i in self.selectedIndexes():
             name = i.data(Qt.UserRole + 0)
             base = os.path.join(g_nais.output_folder(), name)
             if os.path.exists(base + '.png'):
@@ -545,10 +714,13 @@ class GuiImageList(QWidget):
                 send2trash.send2trash(base + '.json')
             if os.path.exists(base + '_tm.png'):
                 send2trash.send2trash(base + '_tm.png')
-            self._list.takeItem(self._list.row(i))
+            g_nais.index.remove(name)
+            g_nais.thumbnails.remove(name)
+            rows.append(i.row())
+        self._model.removeRowsAt(rows)
 
     def export_selected_images_in_zip(self):
-        if len(self._list.selectedItems()) == 0:
+        if len(self.selectedIndexes()) == 0:
             return
         fpath, _ = QFileDialog.getSaveFileName(self, 'Export Selected Images', g_nais.output_folder(), '*.zip')
         if not fpath:
@@ -566,7 +738,7 @@ class GuiImageList(QWidget):
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir)
         os.makedirs(temp_dir)
-        for i in self._list.selectedItems():
+        for i in self.selectedIndexes():
             name = i.data(Qt.UserRole + 0)
             src = os.path.join(g_nais.output_folder(), name + '.png')
             dst = os.path.join(temp_dir, name + '.png')
@@ -582,35 +754,39 @@ class GuiImageList(QWidget):
         prog.autoClose()
 
     def archive_selected_images(self):
-        if len(self._list.selectedItems()) == 0:
+        if len(self.selectedIndexes()) == 0:
             return
-        for i in self._list.selectedItems():
+        rows = []
+        for i in self.selectedIndexes():
             name = i.data(Qt.UserRole + 0)
             src = os.path.join(g_nais.output_folder(), name + '.png')
             os.remove(src)
-            self._list.takeItem(self._list.row(i))
+            g_nais.index.update(name, i.data(Qt.UserRole + 1))
+            rows.append(i.row())
+        self._model.removeRowsAt(rows)
         self.itemArchived.emit()
 
-    def regenerate_selected_images(self):
-        def _job_impl(name, text: str):
-            if g_nais.job_save_image(name, text):
-                self.add(name)
-        for item in self._list.selectedItems():
-            x = json_to_text(item.data(Qt.UserRole + 1))
-            g_job.append(JOB_CHANNEL_REGENERATION,
-                         lambda _x=x: _job_impl(datetime.datetime.now().strftime('%Y%m%d%H%M%S'), _x))
+    def regenerate_selected_images(self, cache: bool = True):
+        payloads = [index.data(Qt.UserRole + 1) for index in self.selectedIndexes()]
+        if not payloads:
+            return
+        params = {'payloads': payloads, 'cache': cache}
+        num, tasks = g_nais.job_tasks(JOB_CHANNEL_REGENERATION, 'payloads', params, len(payloads), self.added.emit)
+        g_job.extend(JOB_CHANNEL_REGENERATION, tasks, num)
 
     def show_in_explorer(self):
-        item = self._list.currentItem()
-        if not item:
+        index = self._list.currentIndex()
+        if not index.isValid():
             return
-        name = item.data(Qt.UserRole + 0)
+        name = index.data(Qt.UserRole + 0)
         path = os.path.join(g_nais.output_folder(), name) + '.png'
         show_in_explorer(path)
 
     def startDrag(self, supportedActions:Qt.DropActions) -> None:
-        item = self._list.currentItem()
-        pathabs = os.path.abspath(os.path.join(g_nais.output_folder(), item.data(Qt.UserRole + 0) + '.png'))
+        index = self._list.currentIndex()
+        if not index.isValid():
+            return
+        pathabs = os.path.abspath(os.path.join(g_nais.output_folder(), index.data(Qt.UserRole + 0) + '.png'))
         path = QUrl.fromLocalFile(pathabs)
         drag = QDrag(self._list)
         mime = QMimeData()
@@ -633,9 +809,6 @@ class GuiImageViewer(NaisImage):
         try:
             self._base_path = os.path.join(g_nais.output_folder(), name)
             self._image = Image.open(self._base_path + '.png')
-            tm = self._image.copy()
-            tm.thumbnail((64, 64), Image.ANTIALIAS)
-            tm.save(f'{self._base_path}_tm.png', "PNG")
             super().setImage(ImageQt(self._image))
         except FileNotFoundError as e:
             print(e)
@@ -661,7 +834,58 @@ class GuiImageData(QWidget):
             print(e)
 
 
+class GuiMetrics(QWidget):
+    def __init__(self):
+        super().__init__()
+        self._summary = QLabel()
+        self._table = QTableWidget(len(NAIS_TIMINGS), 5)
+        self._table.setHorizontalHeaderLabels(['count', 'avg ms', 'p50 ms', 'p95 ms', 'p99 ms'])
+        self._table.setVerticalHeaderLabels(NAIS_TIMINGS)
+        self._table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self._table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self._buttonExport = QPushButton('Export')
+        self._buttonExport.pressed.connect(self.export)
+        self._timer = QTimer(self)
+        self._timer.setInterval(1000)
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start()
+        layout = QVBoxLayout()
+        layout.addWidget(self._summary)
+        layout.addWidget(self._table)
+        layout.addWidget(self._buttonExport)
+        self.setLayout(layout)
+        self.setWindowTitle('Metrics')
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        snapshot = g_nais.metrics.snapshot()
+        counts = snapshot['counts']
+        errors = ', '.join(f'{k} x{v}' for k, v in sorted(snapshot['errors'].items()))
+        self._summary.setText(f"{snapshot['images_per_minute']:.1f} images/min | success {counts['success']}"
+                              f" | cached {counts['cached']} | retry {counts['retry']} | failure {counts['failure']}" +
+                              (f'\n{errors}' if errors else ''))
+        for row, stage in enumerate(NAIS_TIMINGS):
+            t = snapshot['timings'][stage]
+            values = [str(t['count'])] + [f'{t[k] * 1000.0:.0f}' for k in ['average', 'p50', 'p95', 'p99']]
+            for col, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self._table.setItem(row, col, item)
+
+    def export(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export Metrics', g_nais.output_folder(),
+                                              'JSON (*.json);;CSV (*.csv)')
+        if path:
+            try:
+                g_nais.metrics.export(path)
+            except OSError as e:
+                print(e)
+
+
 class GuiMain(QMainWindow):
+    imported = Signal()
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle('Nais GUI')
@@ -673,6 +897,7 @@ class GuiMain(QMainWindow):
         self._image_viewer = GuiImageViewer()
         self._image_data = GuiImageData()
         self._image_var = GuiImageVariations()
+        self._metrics = GuiMetrics()
         self._image_var.generated.connect(self._image_list.add)
         self._progress = QProgressBar()
         self._progress.setAlignment(Qt.AlignCenter)
@@ -682,8 +907,16 @@ class GuiMain(QMainWindow):
         self._image_list.itemChanged.connect(self._image_data.setImage)
         self._image_list.itemChanged.connect(self._image_var.setImage)
         self._image_list.itemArchived.connect(self._archives.refresh)
-        self._job.jobStatusChanged.connect(self.on_job_status_changed)
+        self._prompt.importRequested.connect(self.import_images)
+        self.imported.connect(self._archives.refresh)
+        g_job_status.jobStatusChanged.connect(self.on_job_status_changed)
+        self._throughput = QLabel()
+        self._throughputTimer = QTimer(self)
+        self._throughputTimer.setInterval(1000)
+        self._throughputTimer.timeout.connect(lambda: self._throughput.setText(g_nais.report()))
+        self._throughputTimer.start()
         self.statusBar().addWidget(self._progress, True)
+        self.statusBar().addPermanentWidget(self._throughput)
         self.setDockOptions(QMainWindow.AllowNestedDocks | QMainWindow.AllowTabbedDocks)
         self._menu_window = self.menuBar().addMenu('Window')
         self.dock(self._prompt, Qt.LeftDockWidgetArea)
@@ -692,6 +925,7 @@ class GuiMain(QMainWindow):
         self.dock(self._image_var, Qt.RightDockWidgetArea, r)
         self.dock(self._image_data, Qt.RightDockWidgetArea, r)
         self.dock(self._image_list, Qt.RightDockWidgetArea, r)
+        self.dock(self._metrics, Qt.BottomDockWidgetArea)
 
         menu_file = self.menuBar().addMenu('File')
         action = QAction(self)
@@ -723,6 +957,14 @@ class GuiMain(QMainWindow):
         action.triggered.connect(self._prompt.openTweakScript)
         menu_file.addAction(action)
         action = QAction(self)
+        action.setText('Import Images from Folder')
+        action.triggered.connect(self.import_images_from_folder)
+        menu_file.addAction(action)
+        action = QAction(self)
+        action.setText('Import Images from Zip')
+        action.triggered.connect(self.import_images_from_zip)
+        menu_file.addAction(action)
+        action = QAction(self)
         action.setText('Exit')
         action.triggered.connect(self.close)
         menu_file.addAction(action)
@@ -734,9 +976,27 @@ class GuiMain(QMainWindow):
         action.setText('Edit Export Preprocess')
         action.triggered.connect(self.edit_export_preprocess)
         menu_edit.addAction(action)
+        action = QAction(self)
+        action.setText('Set Concurrency')
+        action.triggered.connect(self.edit_concurrency)
+        menu_edit.addAction(action)
         self._job.start()
+        self.resume_jobs()
         self.load_layout()
 
+    def resume_jobs(self) -> None:
+        # Batches left in the journal by the last session, finished images are not generated again
+        if g_nais.journal is None:
+            return
+        for bid, ch, kind, params, num in g_nais.journal.pending():
+            try:
+                num, tasks = g_nais.job_tasks(ch, kind, params, num, self._image_list.added.emit, bid)
+            except Exception as e:
+                print(e)
+                continue
+            print(f'resuming {num} jobs')
+            g_job.extend(ch, tasks, num)
+
     def edit_export_preprocess(self) -> None:
         path = os.path.join(g_nais.output_folder(), 'export_preprocess.txt')
         txt = read_text(path)
@@ -747,7 +1007,39 @@ class GuiMain(QMainWindow):
             with open(path, 'wt', encoding='utf-8') as f:
                 f.write(txt)
 
+    def import_images_from_folder(self) -> None:
+        path = QFileDialog.getExistingDirectory(self, 'Import Images from Folder')
+        if path:
+            self.import_images([path])
+
+    def import_images_from_zip(self) -> None:
+        path, _ = QFileDialog.getOpenFileName(self, 'Import Images from Zip', '', '*.zip')
+        if path:
+            self.import_images([path])
+
+    def import_images(self, paths: list) -> None:
+        # Imported images land in the archive, ready to be restored
+        def _job_impl():
+            imported, skipped, failed = nais_import(paths, g_nais.output_folder())
+            print(f'imported: {len(imported)}, duplicates: {skipped}, failed: {failed}')
+            self.imported.emit()
+        g_job.append(JOB_CHANNEL_IMPORT, _job_impl)
+
+    def edit_concurrency(self) -> None:
+        num, ok = QInputDialog.getInt(self, 'Set Concurrency', 'Parallel Requests:', self._job.concurrency(), 1, 32)
+        if ok:
+            g_nais.set_concurrency(num)
+            self._job.setConcurrency(num)
+
     def closeEvent(self, event) -> None:
+        # Drop the queue but keep it in the journal to resume next time, then let the requests in flight
+        # finish and get journaled before the journal closes
+        for ch in [JOB_CHANNEL_MAIN, JOB_CHANNEL_VARIATIONS, JOB_CHANNEL_REGENERATION, JOB_CHANNEL_IMPORT]:
+            g_job.cancel(ch)
+        g_job.stop()
+        g_nais.pipeline.flush()
+        if g_nais.journal is not None:
+            g_nais.journal.close()
         self.save_layout()
         super().closeEvent(event)
 
@@ -756,11 +1048,16 @@ class GuiMain(QMainWindow):
             s = QSettings(self._inipath, QSettings.IniFormat)
             self.restoreGeometry(s.value('geometry'))
             self.restoreState(s.value('state'))
+            # The average of the last session estimates sweeps until this one has requested something
+            seconds = s.value('seconds_per_image')
+            if seconds is not None:
+                g_nais.settings['seconds_per_image'] = float(seconds)
 
     def save_layout(self):
         s = QSettings(self._inipath, QSettings.IniFormat)
         s.setValue('geometry', self.saveGeometry())
         s.setValue('state', self.saveState())
+        s.setValue('seconds_per_image', g_nais.seconds_per_image())
 
     def on_job_status_changed(self, done: int, num: int, text: str):
         self._progress.setFormat(text)
@@ -781,6 +1078,11 @@ class GuiMain(QMainWindow):
 
 
 def NaisGui():
+    global g_nais, g_job_status, g_job
+    g_nais = Nais()
+    g_job_status = GuiJobStatus()
+    g_job = NaisJob(g_nais.settings['concurrency'], g_job_status.jobStatusChanged.emit,
+                    g_nais.metrics.timings['queue'].record)
     app = QApplication(sys.argv)
 
     # CLEANUP OLD FILES
@@ -792,21 +1094,24 @@ def NaisGui():
     # LOG IN
     username = os.environ['NAI_USERNAME'] if 'NAI_USERNAME' in os.environ else ''
     password = os.environ['NAI_PASSWORD'] if 'NAI_PASSWORD' in os.environ else ''
-    if not username or not password:
-        dialog = NaisLogin()
-        dialog.exec_()
-        username = dialog.username()
-        password = dialog.password()
-        dialog = None
+    failures = 0
+    error = ''
     while True:
-        try:
-            g_nais.login(username, password)
-        except:
-            dialog = NaisLogin()
-            dialog.exec_()
+        if not username or not password:
+            # After a failure the dialog counts the backoff down itself, the GUI thread never sleeps
+            dialog = NaisLogin(username, error, min(30.0, 2.0 ** (failures - 1)) if failures else 0.0)
+            if dialog.exec_() != QDialog.Accepted:
+                sys.exit(0)
             username = dialog.username()
             password = dialog.password()
             dialog = None
+        try:
+            g_nais.login(username, password)
+        except Exception as e:
+            print(e)
+            failures += 1
+            error = f'Login failed: {e}'
+            password = ''
             continue
         else:
             break
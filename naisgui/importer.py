@@ -0,0 +1,121 @@
+import concurrent.futures
+import copy
+import hashlib
+import multiprocessing
+import os
+import zipfile
+from naisgui.nais import *
+
+
+NAIS_IMPORT_BATCH = 64
+NAIS_IMPORT_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.webp']
+
+NAIS_DEFAULT_DATA = {
+    'input': '',
+    'model': 'nai-diffusion',
+    'parameters': {
+        'n_samples': 1,
+        'seed': 1,
+        'noise': 0.2,
+        'strength': 0.7,
+        'steps': 28,
+        'scale': 11,
+        'width': 512,
+        'height': 768,
+        'uc': '',
+        'sampler': 'k_euler_ancestral',
+    },
+}
+
+
+def nais_import_data(src: dict):
+    data = copy.deepcopy(NAIS_DEFAULT_DATA)
+    data['input'] = src.get('input', '')
+    data['model'] = src.get('model', data['model'])
+    data['parameters'].update(src.get('parameters', {}))
+    return data
+
+
+def nais_import_name(digest: str):
+    return 'import-' + digest[:20]
+
+
+def _import_one(label: str, content: bytes):
+    digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+    data, ret = nais_data_from_image(content)
+    if ret == NAIS_DATA_ERROR:
+        return label, digest, None
+    return label, digest, nais_import_data(data)
+
+
+def _import_batch(archive: str, members: list):
+    # Runs in a worker process, a zip is opened once per batch rather than once per member
+    results = []
+    if archive:
+        with zipfile.ZipFile(archive) as z:
+            for m in members:
+                results.append(_import_one(f'{archive}:{m}', z.read(m)))
+    else:
+        for path in members:
+            with open(path, 'rb') as f:
+                results.append(_import_one(path, f.read()))
+    return results
+
+
+def _import_sources(paths: list):
+    for path in paths:
+        if os.path.isdir(path):
+            files = []
+            for root, dirs, names in os.walk(path):
+                files += [os.path.join(root, n) for n in names
+                          if os.path.splitext(n)[1].lower() in NAIS_IMPORT_EXTENSIONS]
+            yield None, sorted(files)
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as z:
+                yield path, [m for m in z.namelist()
+                             if os.path.splitext(m)[1].lower() in NAIS_IMPORT_EXTENSIONS]
+        else:
+            yield None, [path]
+
+
+def nais_import(paths: list, folder: str, workers: int = None, progress: callable = None):
+    # Extracts metadata in a process pool and writes archive entries (.json without .png) named by content hash
+    batches = []
+    for archive, members in _import_sources(paths):
+        for i in range(0, len(members), NAIS_IMPORT_BATCH):
+            batches.append((archive, members[i:i + NAIS_IMPORT_BATCH]))
+    total = sum(len(b[1]) for b in batches)
+    imported = []
+    skipped = 0
+    failed = 0
+    seen = set()
+    done = 0
+    # Spawned, never forked: the caller is a threaded Qt process and a fork could inherit held locks
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        futures = {pool.submit(_import_batch, archive, members): len(members) for archive, members in batches}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                print(e)
+                done += futures[future]
+                failed += futures[future]
+                continue
+            for label, digest, data in results:
+                done += 1
+                if data is None:
+                    failed += 1
+                    continue
+                name = nais_import_name(digest)
+                path = os.path.join(folder, name + '.json')
+                if digest in seen or os.path.exists(path):
+                    skipped += 1
+                    continue
+                seen.add(digest)
+                with open(path, 'wt', encoding='utf-8') as f:
+                    f.write(json_to_text(data))
+                imported.append(name)
+            if progress:
+                progress(done, total)
+    return imported, skipped, failed
@@ -0,0 +1,238 @@
+import json
+import os
+import sqlite3
+import threading
+from naisgui.util import payload_digest, read_text, text_to_json
+
+
+NAIS_INDEX_FILE = 'index.sqlite3'
+NAIS_INDEX_VERSION = 4
+
+NAIS_TAG_INPUT = 0
+NAIS_TAG_UC = 1
+# The single words of multi-word tags, so "miku" still finds "hatsune miku"
+NAIS_WORD_INPUT = 2
+NAIS_WORD_UC = 3
+
+
+def nais_tag(text: str):
+    for c in '{}[]()':
+        text = text.replace(c, '')
+    return ' '.join(text.lower().split())
+
+
+def nais_tags(text: str):
+    return [t for t in (nais_tag(t) for t in text.split(',')) if t]
+
+
+def _filter_term(term: str):
+    # tag, tag*, uc:tag, sampler:name, seed:1..9, scale:..11, steps:28
+    field, sep, value = term.partition(':')
+    field = field.strip().lower()
+    if not sep or field not in ['uc', 'sampler', 'seed', 'scale', 'steps']:
+        field, value = 'input', term
+    value = value.strip()
+    if field in ['input', 'uc']:
+        # A whole tag or any word of one
+        kinds = (NAIS_TAG_UC, NAIS_WORD_UC) if field == 'uc' else (NAIS_TAG_INPUT, NAIS_WORD_INPUT)
+        if value.endswith('*'):
+            prefix = nais_tag(value[:-1])
+            return 'SELECT name FROM tags WHERE field IN (?, ?) AND tag >= ? AND tag < ?', \
+                kinds + (prefix, prefix + '\U0010ffff')
+        return 'SELECT name FROM tags WHERE field IN (?, ?) AND tag = ?', kinds + (nais_tag(value),)
+    if field == 'sampler':
+        return 'SELECT name FROM images WHERE sampler = ?', (value,)
+    lo, dots, hi = value.partition('..')
+    cast = float if field == 'scale' else int
+    if not dots:
+        return f'SELECT name FROM images WHERE {field} = ?', (cast(lo),)
+    sql, args = f'SELECT name FROM images WHERE {field} IS NOT NULL', []
+    if lo.strip():
+        sql += f' AND {field} >= ?'
+        args.append(cast(lo))
+    if hi.strip():
+        sql += f' AND {field} <= ?'
+        args.append(cast(hi))
+    return sql, tuple(args)
+
+
+def nais_filter_query(text: str, archived: bool = False):
+    # Comma separated terms are ANDed, '|' separates alternatives and a leading '-' or '!' negates a term
+    sql = 'SELECT name FROM images WHERE archived = ?'
+    args = [int(archived)]
+    excluded = []
+    for clause in text.split(','):
+        clause = clause.strip()
+        if not clause:
+            continue
+        negate = clause[0] in '-!'
+        if negate:
+            clause = clause[1:]
+        terms = [_filter_term(t) for t in clause.split('|') if t.strip()]
+        if not terms:
+            continue
+        sub = ' UNION '.join(t[0] for t in terms)
+        sub_args = [a for t in terms for a in t[1]]
+        if len(terms) > 1:
+            sub = f'SELECT name FROM ({sub})'
+        if negate:
+            excluded.append((sub, sub_args))
+        else:
+            sql += ' INTERSECT ' + sub
+            args += sub_args
+    for sub, sub_args in excluded:
+        sql += ' EXCEPT ' + sub
+        args += sub_args
+    return sql, args
+
+
+class NaisIndex():
+    def __init__(self, folder: str):
+        self._folder = folder
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(folder, NAIS_INDEX_FILE), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != NAIS_INDEX_VERSION:
+            self._db.execute('DROP TABLE IF EXISTS images')
+            self._db.execute('DROP TABLE IF EXISTS tags')
+            self._db.execute(f'PRAGMA user_version={NAIS_INDEX_VERSION}')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS images (
+            name TEXT PRIMARY KEY,
+            json_mtime REAL,
+            png_mtime REAL,
+            archived INTEGER,
+            sampler TEXT,
+            seed INTEGER,
+            scale REAL,
+            steps INTEGER,
+            data TEXT,
+            digest TEXT)''')
+        self._db.execute('CREATE TABLE IF NOT EXISTS tags (field INTEGER, tag TEXT, name TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS images_archived ON images (archived, name)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS images_sampler ON images (sampler)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS images_seed ON images (seed)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS images_scale ON images (scale)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS images_steps ON images (steps)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS images_digest ON images (digest, archived)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tags_tag ON tags (field, tag)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tags_name ON tags (name)')
+        self._db.commit()
+
+    def _stat(self, name: str):
+        base = os.path.join(self._folder, name)
+        try:
+            json_mtime = os.stat(base + '.json').st_mtime
+        except FileNotFoundError:
+            return None, None
+        try:
+            png_mtime = os.stat(base + '.png').st_mtime
+        except FileNotFoundError:
+            png_mtime = None
+        return json_mtime, png_mtime
+
+    @staticmethod
+    def _row(name: str, json_mtime, png_mtime, data: dict):
+        params = data.get('parameters', {})
+        return (name, json_mtime, png_mtime, int(png_mtime is None),
+                params.get('sampler'), params.get('seed'), params.get('scale'), params.get('steps'),
+                json.dumps(data, sort_keys=True), payload_digest(data))
+
+    @staticmethod
+    def _tags(name: str, data: dict):
+        tags = set()
+        for kind, word, text in [(NAIS_TAG_INPUT, NAIS_WORD_INPUT, data.get('input', '')),
+                                 (NAIS_TAG_UC, NAIS_WORD_UC, data.get('parameters', {}).get('uc', ''))]:
+            for t in nais_tags(text):
+                tags.add((kind, t, name))
+                if ' ' in t:
+                    tags |= {(word, w, name) for w in t.split()}
+        return tags
+
+    def _write(self, rows, tags):
+        self._db.executemany('DELETE FROM tags WHERE name = ?', [(row[0],) for row in rows])
+        self._db.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self._db.executemany('INSERT INTO tags VALUES (?, ?, ?)', tags)
+
+    def update(self, name: str, data: dict = None):
+        json_mtime, png_mtime = self._stat(name)
+        if json_mtime is None:
+            self.remove(name)
+            return
+        if data is None:
+            data = text_to_json(read_text(os.path.join(self._folder, name + '.json')))
+        with self._lock:
+            self._write([self._row(name, json_mtime, png_mtime, data)], self._tags(name, data))
+            self._db.commit()
+
+    def remove(self, name: str):
+        with self._lock:
+            self._db.execute('DELETE FROM images WHERE name = ?', (name,))
+            self._db.execute('DELETE FROM tags WHERE name = ?', (name,))
+            self._db.commit()
+
+    def refresh(self):
+        # One directory scan, then only the sidecars whose mtime moved are parsed again
+        files = {}
+        with os.scandir(self._folder) as it:
+            for e in it:
+                name, ext = os.path.splitext(e.name)
+                if ext == '.json':
+                    files.setdefault(name, [None, None])[0] = e.stat().st_mtime
+                elif ext == '.png':
+                    files.setdefault(name, [None, None])[1] = e.stat().st_mtime
+        with self._lock:
+            known = {name: (jm, pm) for name, jm, pm in
+                     self._db.execute('SELECT name, json_mtime, png_mtime FROM images')}
+        removed = [(name,) for name in known if name not in files or files[name][0] is None]
+        moved = []
+        changed = []
+        tags = []
+        for name, (json_mtime, png_mtime) in files.items():
+            if json_mtime is None:
+                continue
+            old = known.get(name)
+            if old is not None and old[0] == json_mtime:
+                if old[1] != png_mtime:
+                    moved.append((png_mtime, int(png_mtime is None), name))
+                continue
+            try:
+                data = text_to_json(read_text(os.path.join(self._folder, name + '.json')))
+                changed.append(self._row(name, json_mtime, png_mtime, data))
+                tags.extend(self._tags(name, data))
+            except Exception as e:
+                print(name, e)
+        with self._lock:
+            self._db.executemany('DELETE FROM images WHERE name = ?', removed)
+            self._db.executemany('DELETE FROM tags WHERE name = ?', removed)
+            self._db.executemany('UPDATE images SET png_mtime = ?, archived = ? WHERE name = ?', moved)
+            self._write(changed, tags)
+            self._db.commit()
+        return len(removed) + len(moved) + len(changed)
+
+    def names(self, archived: bool = False):
+        with self._lock:
+            rows = self._db.execute('SELECT name FROM images WHERE archived = ? ORDER BY name',
+                                    (int(archived),)).fetchall()
+        return [name for name, in rows]
+
+    def search(self, text: str, archived: bool = False):
+        sql, args = nais_filter_query(text, archived)
+        with self._lock:
+            return {name for name, in self._db.execute(sql, args)}
+
+    def mtimes(self):
+        with self._lock:
+            return dict(self._db.execute('SELECT name, png_mtime FROM images'))
+
+    def find(self, digest: str, exclude: str = None):
+        # Any image of that payload that still has its PNG, other than exclude
+        with self._lock:
+            row = self._db.execute('SELECT name FROM images WHERE digest = ? AND archived = 0 AND name IS NOT ? '
+                                   'LIMIT 1', (digest, exclude)).fetchone()
+        return row[0] if row else None
+
+    def get(self, name: str):
+        with self._lock:
+            row = self._db.execute('SELECT data FROM images WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else None
@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+from naisgui.sweep import NaisSweep
+from naisgui.tweak import NaisTweak
+
+
+def nais_job_render(kind: str, params: dict, num: int):
+    # Batches are journaled as the recipe, not the rendered payloads; returns a function rendering the i-th one
+    if kind == 'tweak':
+        tweak = NaisTweak(params['text'], params['script'])
+        return lambda i: tweak.render(num, i)
+    if kind == 'sweep':
+        return NaisSweep(params['data'], params['spec']).payload
+    return params['payloads'].__getitem__
+
+
+class NaisJournalBatch():
+    __slots__ = ('id', 'ch', 'kind', 'params', 'num', 'finished', 'names')
+
+    def __init__(self, bid: int, ch: int, kind: str, params: dict, num: int):
+        self.id = bid
+        self.ch = ch
+        self.kind = kind
+        self.params = params
+        self.num = num
+        self.finished = set()
+        self.names = {}
+
+    def record(self):
+        return {'op': 'batch', 'id': self.id, 'ch': self.ch, 'kind': self.kind, 'params': self.params,
+                'num': self.num, 'finished': sorted(self.finished), 'names': self.names}
+
+
+class NaisJournal():
+    def __init__(self, folder: str, compact_every: int = 1000):
+        # Append-only JSON lines: batch (queued), start (in flight), done/fail (completed) and cancel.
+        # Records are flushed as they are written, a torn last line from a crash is skipped on load;
+        # the file is rewritten with only the open batches on load and every compact_every records
+        self._path = os.path.join(folder, 'journal.jsonl')
+        self._lock = threading.Lock()
+        self._batches = {}
+        self._next = 1
+        self._appended = 0
+        self._compact_every = compact_every
+        self._file = None
+        self._load()
+        self.compact()
+
+    def _load(self):
+        try:
+            with open(self._path, 'rt', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                r = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            self._apply(r)
+        self._next = max(self._batches.keys(), default=0) + 1
+
+    def _apply(self, r: dict):
+        op = r.get('op')
+        if op == 'batch':
+            b = NaisJournalBatch(r['id'], r['ch'], r['kind'], r['params'], r['num'])
+            b.finished.update(r.get('finished', []))
+            b.names.update({int(i): name for i, name in r.get('names', {}).items()})
+            self._next = max(self._next, b.id + 1)
+            # A batch with nothing left to do would never see another record, so it isn't kept at all
+            if len(b.finished) < b.num:
+                self._batches[b.id] = b
+            return
+        b = self._batches.get(r.get('id'))
+        if b is None:
+            return
+        if op == 'start':
+            b.names[r['i']] = r['name']
+        elif op in ['done', 'fail']:
+            b.finished.add(r['i'])
+            b.names.pop(r['i'], None)
+            if len(b.finished) >= b.num:
+                del self._batches[b.id]
+        elif op == 'cancel':
+            del self._batches[b.id]
+
+    def _append(self, r: dict, sync: bool = False):
+        self._file.write(json.dumps(r, ensure_ascii=False) + '\n')
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        self._appended += 1
+        if self._appended >= self._compact_every:
+            self._compact()
+
+    def _write(self, r: dict, sync: bool = False):
+        with self._lock:
+            if self._file is None:
+                return
+            if r['op'] != 'batch' and r['id'] not in self._batches:
+                return
+            self._apply(r)
+            self._append(r, sync)
+
+    def begin(self, ch: int, kind: str, params: dict, num: int):
+        with self._lock:
+            bid = self._next
+            self._next += 1
+        # The recipe is the one thing that can't be recovered, make sure it hits the disk
+        self._write({'op': 'batch', 'id': bid, 'ch': ch, 'kind': kind, 'params': params, 'num': num}, True)
+        return bid
+
+    def start(self, bid: int, i: int, name: str):
+        self._write({'op': 'start', 'id': bid, 'i': i, 'name': name})
+
+    def finish(self, bid: int, i: int, ok: bool = True):
+        self._write({'op': 'done' if ok else 'fail', 'id': bid, 'i': i})
+
+    def cancel(self, ch: int):
+        with self._lock:
+            bids = [b.id for b in self._batches.values() if b.ch == ch]
+        for bid in bids:
+            self._write({'op': 'cancel', 'id': bid})
+
+    def progress(self, bid: int):
+        # Finished indices and the names of the ones in flight, which are reused on replay
+        with self._lock:
+            b = self._batches.get(bid)
+            return (set(b.finished), dict(b.names)) if b else (set(), {})
+
+    def pending(self):
+        with self._lock:
+            return [(b.id, b.ch, b.kind, b.params, b.num) for b in self._batches.values()]
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+        tmp = self._path + '.tmp'
+        with open(tmp, 'wt', encoding='utf-8') as f:
+            for b in self._batches.values():
+                f.write(json.dumps(b.record(), ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path)
+        self._file = open(self._path, 'at', encoding='utf-8')
+        self._appended = 0
+
+    def close(self):
+        with self._lock:
+            self._compact()
+            self._file.close()
+            self._file = None
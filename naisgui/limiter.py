@@ -0,0 +1,80 @@
+import threading
+import time
+
+
+class NaisLimiter():
+    def __init__(self, rate: float = 1.0, burst: float = 2.0, rate_min: float = 0.05, rate_max: float = 10.0,
+                 limit_min: int = 1, limit_max: int = 2, tolerance: float = 2.0, enabled: bool = True):
+        # Token bucket for the request rate plus an AIMD window for requests in flight:
+        # successes grow both additively, 429/503 halve them and slow responses shrink the window
+        self._cond = threading.Condition()
+        self.enabled = enabled
+        self.rate = rate
+        self.burst = burst
+        self.rate_min = rate_min
+        self.rate_max = rate_max
+        self.limit_min = limit_min
+        self.limit_max = limit_max
+        self.limit = float(limit_min)
+        self.tolerance = tolerance
+        self.baseline = None
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._inflight = 0
+
+    def setMaximum(self, num: int):
+        with self._cond:
+            self.limit_max = max(self.limit_min, num)
+            self.limit = min(self.limit, self.limit_max)
+            self._cond.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def _take(self):
+        # None once a slot is taken, otherwise how long to wait; 0 waits for a release
+        if self.enabled:
+            self._refill()
+            if self._inflight >= max(1, int(self.limit)) or self._tokens < 1.0:
+                return (1.0 - self._tokens) / self.rate if self._tokens < 1.0 else 0.0
+            self._tokens -= 1.0
+        self._inflight += 1
+        return None
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self._take()
+                if wait is None:
+                    return
+                self._cond.wait(wait or None)
+
+    def poll(self):
+        # Non-blocking acquire for callers that can't block their thread, e.g. an event loop
+        with self._cond:
+            return self._take()
+
+    def release(self, latency: float = None, throttled: bool = False):
+        with self._cond:
+            self._inflight -= 1
+            if throttled:
+                self.limit = max(self.limit_min, self.limit * 0.5)
+                self.rate = max(self.rate_min, self.rate * 0.5)
+            elif latency is not None:
+                # The baseline follows the fastest responses and only creeps up slowly
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    self.baseline += (latency - self.baseline) * 0.05
+                if latency > self.baseline * self.tolerance:
+                    self.limit = max(self.limit_min, self.limit * 0.9)
+                else:
+                    self.limit = min(self.limit_max, self.limit + 1.0 / self.limit)
+                    self.rate = min(self.rate_max, self.rate + 0.05)
+            self._cond.notify_all()
+
+    def report(self):
+        with self._cond:
+            return f'in flight {self._inflight}/{int(self.limit)} @ {self.rate:.2f}/s'
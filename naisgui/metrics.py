@@ -0,0 +1,69 @@
+import collections
+import csv
+import io
+import json
+import threading
+import time
+from naisgui.pipeline import NaisStageStats
+
+
+NAIS_TIMINGS = ['queue', 'network', 'decode', 'write']
+NAIS_COUNTS = ['success', 'cached', 'retry', 'failure']
+
+
+class NaisMetrics():
+    def __init__(self, stats: dict = None, errors: collections.Counter = None):
+        # Stages already measured elsewhere (the pipeline's write) are shared, not measured twice
+        stats = stats or {}
+        self.timings = {k: stats.get(k) or NaisStageStats() for k in NAIS_TIMINGS}
+        self.counts = collections.Counter({k: 0 for k in NAIS_COUNTS})
+        self.errors = errors
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def count(self, key: str, num: int = 1):
+        with self._lock:
+            self.counts[key] += num
+
+    def images_per_minute(self):
+        return self.timings['write'].per_minute()
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self._start,
+            'images_per_minute': self.images_per_minute(),
+            'counts': counts,
+            'errors': dict(self.errors) if self.errors is not None else {},
+            'timings': {k: {
+                'count': s.count,
+                'average': s.average(),
+                'p50': s.percentile(50),
+                'p95': s.percentile(95),
+                'p99': s.percentile(99),
+            } for k, s in self.timings.items()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_csv(self):
+        # One flattened "metric,value" row per number so runs are easy to diff or paste into a sheet
+        f = io.StringIO()
+        w = csv.writer(f, lineterminator='\n')
+        w.writerow(['metric', 'value'])
+
+        def rows(prefix: str, obj):
+            for k, v in obj.items():
+                if isinstance(v, dict):
+                    rows(f'{prefix}{k}.', v)
+                else:
+                    w.writerow([prefix + k, v])
+        rows('', self.snapshot())
+        return f.getvalue()
+
+    def export(self, path: str):
+        with open(path, 'wt', encoding='utf-8', newline='') as f:
+            f.write(self.to_csv() if path.lower().endswith('.csv') else self.to_json())
@@ -0,0 +1,183 @@
+import base64
+import http.server
+import io
+import json
+import os
+import random
+import threading
+import time
+import zipfile
+from PIL import Image
+
+
+NAIS_MOCK_FORMATS = ['event', 'zip', 'png']
+
+
+def nais_mock_token(ttl: float):
+    def part(obj):
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).rstrip(b'=').decode()
+    return f"{part({'alg': 'none'})}.{part({'exp': int(time.time() + ttl), 'jti': os.urandom(8).hex()})}.mock"
+
+
+class NaisMockServer():
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.5, jitter: float = 0.1,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, retry_after: float = 1.0,
+                 fmt: str = 'event', token_ttl: float = 3600.0, noise: bool = True):
+        # Stand-in for /user/login and /ai/generate-image; any key logs in, images are random noise
+        # of the requested size so they compress like real ones
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.format = fmt
+        self.token_ttl = token_ttl
+        self.noise = noise
+        self.counts = {'login': 0, 'ok': 0, '401': 0, '429': 0, '500': 0}
+        self.inflight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._images = {}
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def _count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+    def image(self, width: int, height: int):
+        with self._lock:
+            png = self._images.get((width, height))
+        if png is None:
+            if self.noise:
+                im = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+            else:
+                im = Image.new('RGB', (width, height), (128, 128, 128))
+            f = io.BytesIO()
+            im.save(f, 'PNG')
+            png = f.getvalue()
+            with self._lock:
+                self._images[(width, height)] = png
+        return png
+
+    def body(self, png: bytes):
+        if self.format == 'zip':
+            f = io.BytesIO()
+            with zipfile.ZipFile(f, 'w') as z:
+                z.writestr('image_0.png', png)
+            return f.getvalue(), 'application/x-zip-compressed'
+        if self.format == 'png':
+            return png, 'image/png'
+        return b'event: newImage\nid: 1\ndata:' + base64.b64encode(png) + b'\n\n', 'text/event-stream'
+
+    def login(self):
+        token = nais_mock_token(self.token_ttl)
+        with self._lock:
+            self._tokens[token] = time.time() + self.token_ttl
+            self.counts['login'] += 1
+        return token
+
+    def authorized(self, header: str):
+        token = (header or '')[len('Bearer '):]
+        with self._lock:
+            return self._tokens.get(token, 0.0) > time.time()
+
+    def _handler(self):
+        mock = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status: int, body: bytes, content_type: str = 'application/json', headers: dict = None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                try:
+                    args = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+                except ValueError:
+                    return self.reply(400, b'{"message": "bad json"}')
+                if self.path == '/user/login':
+                    return self.reply(201, json.dumps({'accessToken': mock.login()}).encode())
+                if self.path != '/ai/generate-image':
+                    return self.reply(404, b'{"message": "not found"}')
+                if not mock.authorized(self.headers.get('Authorization')):
+                    mock._count('401')
+                    return self.reply(401, b'{"message": "unauthorized"}')
+                with mock._lock:
+                    mock.inflight += 1
+                    mock.peak = max(mock.peak, mock.inflight)
+                try:
+                    self.generate(args)
+                finally:
+                    with mock._lock:
+                        mock.inflight -= 1
+
+            def generate(self, args: dict):
+                r = random.random()
+                if r < mock.throttle_rate:
+                    mock._count('429')
+                    return self.reply(429, b'{"message": "too many requests"}',
+                                      headers={'Retry-After': f'{mock.retry_after:g}'})
+                time.sleep(max(0.0, random.gauss(mock.latency, mock.jitter)))
+                if r < mock.throttle_rate + mock.error_rate:
+                    mock._count('500')
+                    return self.reply(500, b'{"message": "internal error"}')
+                params = args.get('parameters', {})
+                png = mock.image(int(params.get('width', 512)), int(params.get('height', 768)))
+                body, content_type = mock.body(png)
+                mock._count('ok')
+                self.reply(200, body, content_type)
+        return Handler
+
+
+def nais_mock_parser(parser):
+    parser.add_argument('--latency', type=float, default=0.5, help='mean seconds per image')
+    parser.add_argument('--jitter', type=float, default=0.1, help='latency standard deviation')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 500 responses')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of 429 responses')
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--format', choices=NAIS_MOCK_FORMATS, default='event')
+    parser.add_argument('--token-ttl', type=float, default=3600.0, help='seconds until tokens answer 401')
+
+
+def nais_mock_server(args, host: str = '127.0.0.1', port: int = 0):
+    return NaisMockServer(host, port, args.latency, args.jitter, args.error_rate, args.throttle_rate,
+                          args.retry_after, args.format, args.token_ttl)
+
+
+def nais_mock(args):
+    mock = nais_mock_server(args, args.host, args.port)
+    print(f'serving on {mock.url()}, point settings["root"] or --root there')
+    try:
+        mock.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(mock.counts)
+    return 0
@@ -1,13 +1,27 @@
-import base64
+import binascii
+import datetime
 import io
 import json
 import os
 import requests
+import shutil
+import threading
+import time
+import zipfile
+from naisgui.credentials import NaisCredentials
+from naisgui.index import NaisIndex
+from naisgui.journal import NaisJournal, nais_job_render
+from naisgui.limiter import NaisLimiter
+from naisgui.metrics import NaisMetrics
+from naisgui.pipeline import NaisPipeline
+from naisgui.transport import nais_transport
+from naisgui.retry import *
+from naisgui.png import PNG_SIGNATURE, read_png_text, write_png_with_text
+from naisgui.thumbnail import NaisThumbnails
 from naisgui.util import *
 from argon2 import low_level
 from base64 import urlsafe_b64encode
 from hashlib import blake2b
-from http.cookies import SimpleCookie
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 
@@ -17,12 +31,21 @@ NAIS_DATA_INCOMPLETE = 1
 NAIS_DATA_ERROR = -1
 
 
+def nais_image_info(arg):
+    info = read_png_text(arg)
+    if info is None:
+        # Not a PNG, let PIL read whatever metadata the format has without decoding pixels
+        if hasattr(arg, 'seek'):
+            arg.seek(0)
+        with Image.open(io.BytesIO(arg) if isinstance(arg, bytes) else arg) as im:
+            info = dict(im.info)
+    return info
+
+
 def nais_data_from_image(arg):
     try:
-        im = Image.open(arg)
-        im.load()
-        print(im.info)
-        if not im.info:
+        info = nais_image_info(arg)
+        if not info:
             print('NO DATA')
             return {}, NAIS_DATA_ERROR
     except Exception as e:
@@ -30,9 +53,9 @@ def nais_data_from_image(arg):
     try:
         # NovelAI
         return {
-                   'input': im.info['Description'],
+                   'input': info['Description'],
                    'model': 'nai-diffusion',
-                   'parameters': json.loads(im.info['Comment'])
+                   'parameters': json.loads(info['Comment'])
                }, NAIS_DATA_COMPLETE
     except Exception as e:
         pass
@@ -43,7 +66,7 @@ def nais_data_from_image(arg):
         }
         # AIBooru?
         afterNegativePrompt = False
-        for x in im.info['parameters'].split('\n'):
+        for x in info['parameters'].split('\n'):
             if not afterNegativePrompt:
                 if x.startswith('Negative prompt:'):
                     data['parameters']['uc'] = x[len('Negative prompt:'):]
@@ -60,7 +83,7 @@ def nais_data_from_image(arg):
                     if y.startswith('Steps:'):
                         data['parameters']['steps'] = int(y[len('Steps:'):].strip())
                     elif y.startswith('CFG scale:'):
-                        data['parameters']['scale'] = int(y[len('CFG scale:'):].strip())
+                        data['parameters']['scale'] = float(y[len('CFG scale:'):].strip())
                     elif y.startswith('Seed:'):
                         data['parameters']['seed'] = int(y[len('Seed:'):].strip())
                     elif y.startswith('Size:'):
@@ -85,97 +108,460 @@ def nais_data_from_local_image(path):
 
 def nais_data_from_uploaded_image(path):
     response = requests.get(path)
-    return nais_data_from_image(io.BytesIO(response.content))
+    return nais_data_from_image(response.content)
+
+
+class NaisImageDecoder():
+    def __init__(self, length: int = 0):
+        # Fed chunk by chunk from a sync or async body: zip and raw PNG bodies are collected into one buffer
+        # preallocated from the body length, event streams have their "data:" field base64-decoded on the fly
+        self._length = length
+        self._mode = None
+        self._sniff = b''
+        self._buf = None
+        self._pos = 0
+        self._head = b''
+        self._pending = b''
+        self._found = False
+        self.done = False
+        self.seconds = 0.0
+
+    def _write(self, data):
+        # Slice assignment fills the preallocated buffer and only grows it past the announced length
+        self._buf[self._pos:self._pos + len(data)] = data
+        self._pos += len(data)
+
+    def feed(self, chunk: bytes):
+        t = time.monotonic()
+        try:
+            self._feed(chunk)
+        finally:
+            self.seconds += time.monotonic() - t
+
+    def _feed(self, chunk: bytes):
+        if self.done or not chunk:
+            return
+        if self._mode is None:
+            self._sniff += chunk
+            if len(self._sniff) < len(PNG_SIGNATURE):
+                return
+            chunk = self._sniff
+            self._sniff = b''
+            if chunk.startswith(b'PK'):
+                self._mode = 'zip'
+            elif chunk.startswith(PNG_SIGNATURE):
+                self._mode = 'png'
+            else:
+                self._mode = 'event'
+            self._buf = bytearray(self._length * 3 // 4 if self._mode == 'event' else self._length)
+        if self._mode != 'event':
+            self._write(chunk)
+            return
+        if not self._found:
+            self._head += chunk
+            i = self._head.find(b'data:')
+            while i > 0 and self._head[i - 1] not in b'\r\n':
+                i = self._head.find(b'data:', i + 1)
+            if i < 0:
+                return
+            chunk = self._head[i + 5:]
+            self._head = b''
+            self._found = True
+        end = chunk.find(b'\n')
+        if end >= 0:
+            chunk = chunk[:end]
+            self.done = True
+        data = self._pending + chunk.strip()
+        num = len(data) if self.done else len(data) - len(data) % 4
+        self._write(binascii.a2b_base64(data[:num]))
+        self._pending = data[num:]
+
+    def finish(self):
+        t = time.monotonic()
+        try:
+            return self._finish()
+        finally:
+            self.seconds += time.monotonic() - t
+
+    def decode(self, chunks):
+        for chunk in chunks:
+            self.feed(chunk)
+            if self.done:
+                break
+        return self.finish()
+
+    def _finish(self):
+        if self._mode is None:
+            raise RuntimeError('Empty response!')
+        if self._mode == 'event':
+            if not self._found:
+                raise RuntimeError('No image data in response!')
+            if self._pending:
+                self._write(binascii.a2b_base64(self._pending))
+                self._pending = b''
+        del self._buf[self._pos:]
+        if self._mode == 'zip':
+            return nais_decode_zip(self._buf)
+        return self._buf
+
+
+def nais_decode_zip(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        return z.read(z.namelist()[0])
+
+
+def nais_access_key(email: str, password: str):
+    pre_salt = password[:6] + email + "novelai_data_access_key"
+    blake = blake2b(digest_size=16)
+    blake.update(pre_salt.encode())
+    salt = blake.digest()
+    raw = low_level.hash_secret_raw(password.encode(), salt, 2, int(2000000 / 1024), 1, 64, low_level.Type.ID)
+    hashed = urlsafe_b64encode(raw).decode()
+    return hashed[:64]
 
 
 class Nais():
-    def __init__(self):
+    def __init__(self, settings: dict = None):
         super().__init__()
-        self._session = requests.session()
-        self._headers = {}
-        self._cookies = SimpleCookie()
         self._accessKey = None
+        self._name_lock = threading.Lock()
+        self._last_name = ''
+        self._name_count = 0
         self.settings = {
             'root': 'https://api.novelai.net',
             'timeout': 10.0,
             'output_folder': '.data',
+            'concurrency': 2,
+            'retry_attempts': 5,
+            'retry_base': 1.0,
+            'retry_cap': 60.0,
+            'limiter': True,
+            'rate': 1.0,
+            'rate_min': 0.05,
+            'rate_max': 10.0,
+            'burst': 2.0,
+            'latency_tolerance': 2.0,
+            'credentials_cache': True,
+            'transport': 'requests',
+            'http2': False,
+            'journal': True,
+            'result_cache': True,
+            'seconds_per_image': 8.0,
         }
+        self.settings.update(settings or {})
+        self.transport = nais_transport(self.settings['transport'], self._pool_size(), self.settings['http2'])
+        self._headers = self.transport.headers
+        self.credentials = NaisCredentials()
+        self._credentialId = None
+        self.retry = NaisRetryPolicy(self.settings['retry_attempts'], self.settings['retry_base'],
+                                     self.settings['retry_cap'])
+        self.limiter = NaisLimiter(self.settings['rate'], self.settings['burst'], self.settings['rate_min'],
+                                   self.settings['rate_max'], 1, self.settings['concurrency'],
+                                   self.settings['latency_tolerance'], self.settings['limiter'])
+        self._login_lock = threading.Lock()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
 
         if not os.path.exists(self.output_folder()):
             os.makedirs(self.output_folder(), exist_ok=True)
+        self.pipeline = NaisPipeline(self.write_image)
+        self.metrics = NaisMetrics(self.pipeline.stats, self.retry.counts)
+        self.index = NaisIndex(self.output_folder())
+        self.thumbnails = NaisThumbnails(self.output_folder(), stats=self.pipeline.stats['thumbnail'])
+        self.journal = NaisJournal(self.output_folder()) if self.settings['journal'] else None
+
+    def report(self):
+        retries = self.retry.report()
+        http = self.transport.stats()
+        reuse = 1.0 - http['connections'] / http['requests'] if http['requests'] else 0.0
+        return (self.pipeline.report() + f' | {self.limiter.report()}' +
+                f' | {http["connections"]} conn, {reuse:.0%} reuse' +
+                (f' | failures: {retries}' if retries else ''))
+
+    def _pool_size(self):
+        # Every worker keeps a connection plus one spare for login and uploads
+        return self.settings['concurrency'] + 1
+
+    def seconds_per_image(self):
+        # Measured this session once anything was requested, else the setting (the GUI keeps the last average)
+        seconds = self.metrics.timings['network'].average() + self.metrics.timings['decode'].average()
+        return seconds if seconds > 0.0 else self.settings['seconds_per_image']
+
+    def set_concurrency(self, num: int):
+        self.settings['concurrency'] = num
+        self.limiter.setMaximum(num)
+        self.transport.resize(self._pool_size())
 
     def output_folder(self):
         return self.settings['output_folder']
 
+    def new_image_name(self):
+        # Parallel jobs can start within the same second, so suffix a counter to keep names unique
+        with self._name_lock:
+            name = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+            if name == self._last_name:
+                self._name_count += 1
+                return f'{name}-{self._name_count}'
+            self._last_name = name
+            self._name_count = 0
+            return name
+
     def login(self, email: str, password: str):
-        pre_salt = password[:6] + email + "novelai_data_access_key"
-        blake = blake2b(digest_size=16)
-        blake.update(pre_salt.encode())
-        salt = blake.digest()
-        raw = low_level.hash_secret_raw(password.encode(), salt, 2, int(2000000 / 1024), 1, 64, low_level.Type.ID)
-        hashed = urlsafe_b64encode(raw).decode()
-        resp = self.post('/user/login', {"key": hashed[:64]})
+        self._credentialId = NaisCredentials.id(email) if self.settings['credentials_cache'] else None
+        entry = self.credentials.load(self._credentialId) if self._credentialId else None
+        if entry:
+            # Skip argon2 with the cached key, and the round trip too while the token is still valid
+            self._accessKey = entry['key']
+            if NaisCredentials.valid(entry):
+                self._headers['Authorization'] = f"Bearer {entry['token']}"
+                print('logged in. (cached)')
+                return
+            try:
+                self.relogin()
+                print('logged in.')
+                return
+            except NaisError as e:
+                print(e)
+                self.credentials.forget(self._credentialId)
+        self._accessKey = nais_access_key(email, password)
+        self.relogin()
+        print('logged in.')
+
+    def relogin(self):
+        resp = self.post('/user/login', {"key": self._accessKey})
+        if resp.status_code not in [200, 201]:
+            raise NaisError(f'Login failed! {resp.status_code}', resp.status_code)
         token = json.loads(resp.content.decode('utf-8'))['accessToken']
         self._headers['Authorization'] = f"Bearer {token}"
-        print('logged in.')
+        if self._credentialId:
+            self.credentials.save(self._credentialId, self._accessKey, token)
+
+    def _relogin_once(self, stale: str):
+        # Parallel workers hit the same 401, only the first one logs in again
+        with self._login_lock:
+            if self._headers.get('Authorization') == stale:
+                self.relogin()
 
-    def post(self, url, args):
-        kwargs = {
+    def post(self, url, args, **kwargs):
+        # Headers live on the transport and are sent with every request
+        kwargs.update({
             'timeout': self.settings['timeout'],
-            'cookies': self._cookies,
-            'headers': self._headers,
             'json' if type(args) is dict else 'data': args,
-        }
-        return self._session.post(self.settings['root'] + url, **kwargs)
+        })
+        return self.transport.post(self.settings['root'] + url, **kwargs)
 
     def gen_image(self, args):
         if type(args) is str:
             args = text_to_json(args)
-        resp = self.post('/ai/generate-image', args)
-        print(resp, resp.content)
-        if resp.status_code != 201:
-            raise RuntimeError("Bad Response!")
-        text = resp.content.decode('utf-8')
-        data = {}
-        for l in text.splitlines():
-            l = l.strip()
-            if not l:
-                continue
-            k, v = l.split(':')
-            data[k] = v
-        bin = base64.b64decode(data['data'])
-        return bin
+        self.limiter.acquire()
+        t = time.monotonic()
+        latency = None
+        throttled = False
+        try:
+            with self.post('/ai/generate-image', args, stream=True) as resp:
+                if resp.status_code not in [200, 201]:
+                    throttled = resp.status_code in [429, 503]
+                    raise NaisError(f'Bad Response! {resp.status_code} {resp.text[:256]}', resp.status_code,
+                                    parse_retry_after(resp.headers.get('Retry-After')))
+                decoder = NaisImageDecoder(int(resp.headers.get('Content-Length') or 0))
+                try:
+                    data = decoder.decode(resp.iter_content(1 << 16))
+                except (binascii.Error, zipfile.BadZipFile, RuntimeError) as e:
+                    raise NaisError(f'Broken Response! {e}')
+                latency = time.monotonic() - t
+                # Decoding runs between reads, the rest of the request is network
+                self.metrics.timings['network'].record(latency - decoder.seconds)
+                self.metrics.timings['decode'].record(decoder.seconds)
+                return data
+        finally:
+            self.limiter.release(latency, throttled)
 
-    def save_image(self, name, args):
+    def request_image(self, name, args):
+        base = os.path.join(self.output_folder(), name)
+        with open(f'{base}.json', 'wt', encoding='utf-8') as f:
+            f.write(json_to_text(args))
+        with self.pipeline.stats['request'].measure():
+            im_bin = self.gen_image(args)
+        return name, args, im_bin
+
+    def write_image(self, name, args, im_bin):
+        base = os.path.join(self.output_folder(), name)
+        texts = {
+            'Title': 'AI generated image',
+            'Software': 'NovelAI',
+            'Source': 'Stable Diffusion 81274D13',  # FIXME
+            'Description': args['input'],
+            'Comment': json.dumps(args['parameters'], sort_keys=True),
+        }
+        if bytes(im_bin[:len(PNG_SIGNATURE)]) == PNG_SIGNATURE:
+            # Splice the metadata into the returned bytes, no decode or re-compression
+            write_png_with_text(f'{base}.png', im_bin, texts)
+        else:
+            im = Image.open(io.BytesIO(im_bin))
+            metadata = PngInfo()
+            for k, v in texts.items():
+                metadata.add_text(k, v)
+            im.save(f'{base}.png', 'PNG', pnginfo=metadata)
+        self.index.update(name, args)
+        self.thumbnails.request(name)
+        return name
+
+    def reuse_image(self, name: str, args: dict, digest: str = None):
+        # A finished image of the same canonical payload stands in for the request, linked rather than copied;
+        # returns the name of that image. The image's own name never counts: if its row is indexed but this is
+        # reached, the PNG is gone (see image_exists in job_tasks) and has to be requested again
+        hit = self.index.find(digest or payload_digest(args), name)
+        if hit is None:
+            return None
         base = os.path.join(self.output_folder(), name)
+        src = os.path.join(self.output_folder(), hit + '.png')
+        try:
+            with open(f'{base}.json', 'wt', encoding='utf-8') as f:
+                f.write(json_to_text(args))
+            try:
+                os.link(src, f'{base}.png')
+            except OSError:
+                shutil.copyfile(src, f'{base}.png')
+        except OSError as e:
+            print(e)
+            return None
+        self.index.update(name, args)
+        self.thumbnails.request(name)
+        return hit
+
+    def image_exists(self, name: str, args: dict):
+        # The image was written from this very payload, e.g. by an earlier run of a resumed job
+        data = self.index.get(name)
+        return data is not None and payload_digest(data) == payload_digest(args) and \
+            os.path.exists(os.path.join(self.output_folder(), name + '.png'))
+
+    def claim_payload(self, digest: str):
+        # None if the caller now owns the payload, otherwise an event set once its owner is done with it
+        with self._inflight_lock:
+            done = self._inflight.get(digest)
+            if done is None:
+                self._inflight[digest] = threading.Event()
+            return done
+
+    def release_payload(self, digest: str):
+        with self._inflight_lock:
+            done = self._inflight.pop(digest, None)
+        if done is not None:
+            done.set()
+
+    def save_image(self, name, args):
         if type(args) is str:
             try:
                 args = text_to_json(args)
             except Exception as e:
                 print(e)
                 return
-        with open(f'{base}.json', 'wt', encoding='utf-8') as f:
-            f.write(json_to_text(args))
-        im_bin = self.gen_image(args)
-        im = Image.open(io.BytesIO(im_bin))
-
-        metadata = PngInfo()
-        metadata.add_text("Title", 'AI generated image')
-        metadata.add_text("Software", 'NovelAI')
-        metadata.add_text("Source", 'Stable Diffusion 81274D13')  # FIXME
-        metadata.add_text("Description", args["input"])
-        metadata.add_text("Comment", json.dumps(args["parameters"], sort_keys=True))
-        im.save(f'{base}.png', 'PNG', pnginfo=metadata)
-        im.thumbnail((64, 64), Image.ANTIALIAS)
-        im.save(f'{base}_tm.png', "PNG")
-
-    def job_save_image(self, name: str, text: str):
-        for i in range(5):
+        self.write_image(*self.request_image(name, args))
+
+    def job_save_image(self, name: str, text: str, on_saved: callable = None, cache: bool = True):
+        # Only the request is retried here, writing happens on the pipeline while the worker moves on
+        args = text
+        if type(args) is str:
             try:
-                self.save_image(name, text)
+                args = text_to_json(args)
+            except Exception as e:
+                print(e)
+                return False
+        digest = None
+        if cache and self.settings['result_cache']:
+            # Duplicates in flight at the same time wait for the first one's image instead of requesting it too
+            digest = payload_digest(args)
+            while True:
+                done = self.claim_payload(digest)
+                if done is None:
+                    break
+                done.wait()
+            hit = self.reuse_image(name, args, digest)
+            if hit is not None:
+                self.release_payload(digest)
+                self.metrics.count('cached')
+                if on_saved is not None:
+                    on_saved(name)
                 return True
+        item = None
+        try:
+            item = self._request_with_retry(name, args)
+        finally:
+            if item is None and digest is not None:
+                self.release_payload(digest)
+        if item is None:
+            return False
+        self.pipeline.submit(item, on_saved, (lambda: self.release_payload(digest)) if digest is not None else None)
+        return True
+
+    def _request_with_retry(self, name: str, args: dict):
+        record = self.retry.record(name)
+        while record.attempts < self.retry.attempts:
+            record.attempts += 1
+            auth = self._headers.get('Authorization')
+            try:
+                item = self.request_image(name, args)
             except Exception as e:
                 print(e)
-                time.sleep(1)
-        return False
+                self.retry.failed(record, e)
+                action = self.retry.classify(e)
+                if action == NAIS_RETRY_NEVER:
+                    self.metrics.count('failure')
+                    return None
+                self.metrics.count('retry')
+                if action == NAIS_RETRY_LOGIN:
+                    try:
+                        self._relogin_once(auth)
+                    except Exception as e:
+                        print(e)
+                        self.metrics.count('failure')
+                        return None
+                    continue
+                time.sleep(self.retry.delay(record.attempts - 1, e))
+                continue
+            record.ok = True
+            self.metrics.count('success')
+            return item
+        self.metrics.count('failure')
+        return None
+
+    def job_tasks(self, ch: int, kind: str, params: dict, num: int, on_saved: callable = None, bid: int = None):
+        # Lazy job tasks for a batch recipe (see nais_job_render), journaled so they survive a restart;
+        # pass the id of a pending journal batch to resume it. Payloads are rendered by the task itself,
+        # outside the job queue's lock, and a payload that fails to render fails only its own index
+        if num <= 0:
+            return 0, iter(())
+        journal = self.journal
+        render = nais_job_render(kind, params, num)
+        if journal is not None and bid is None:
+            bid = journal.begin(ch, kind, params, num)
+        finished, names = journal.progress(bid) if journal is not None else (set(), {})
+        fixed = params.get('names')
+        cache = params.get('cache', True)
+
+        def task(i: int):
+            try:
+                args = render(i)
+            except Exception as e:
+                print(f'payload {i}: {e}')
+                self.metrics.count('failure')
+                if journal is not None:
+                    journal.finish(bid, i, False)
+                return
+            name = names.get(i) or (fixed[i] if fixed else self.new_image_name())
+            if (i in names or cache) and self.image_exists(name, args):
+                # Written before a restart, or a regeneration of an unchanged payload; it's already listed
+                if journal is not None:
+                    journal.finish(bid, i)
+                return
+            if journal is not None:
+                journal.start(bid, i, name)
 
+            def saved(name):
+                if journal is not None:
+                    journal.finish(bid, i)
+                if on_saved is not None:
+                    on_saved(name)
+            if not self.job_save_image(name, args, saved, cache) and journal is not None:
+                journal.finish(bid, i, False)
+        return num - len(finished), (lambda i=i: task(i) for i in range(num) if i not in finished)
@@ -0,0 +1,98 @@
+import collections
+import contextlib
+import queue
+import threading
+import time
+
+
+NAIS_STAGES = ['request', 'write', 'thumbnail', 'notify']
+
+
+class NaisStageStats():
+    def __init__(self, window: float = 60.0, samples: int = 1024):
+        self._lock = threading.Lock()
+        self._window = window
+        self._times = collections.deque()
+        self._samples = collections.deque(maxlen=samples)
+        self._start = None
+        self.count = 0
+        self.busy = 0.0
+
+    def record(self, seconds: float = 0.0):
+        now = time.monotonic()
+        with self._lock:
+            if self._start is None:
+                self._start = now - seconds
+            self.count += 1
+            self.busy += seconds
+            self._times.append(now)
+            self._samples.append(seconds)
+            self._purge(now)
+
+    @contextlib.contextmanager
+    def measure(self):
+        t = time.monotonic()
+        yield
+        self.record(time.monotonic() - t)
+
+    def _purge(self, now: float):
+        while self._times and self._times[0] < now - self._window:
+            self._times.popleft()
+
+    def per_minute(self):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            if self._start is None:
+                return 0.0
+            elapsed = min(self._window, now - self._start)
+            return len(self._times) * 60.0 / elapsed if elapsed > 0.0 else 0.0
+
+    def average(self):
+        with self._lock:
+            return self.busy / self.count if self.count else 0.0
+
+    def percentile(self, p: float):
+        # Over the most recent samples only
+        with self._lock:
+            values = sorted(self._samples)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class NaisPipeline():
+    def __init__(self, write: callable, depth: int = 8):
+        # request (job workers) -> write -> notify on one writer thread, thumbnails on their own pool;
+        # the bounded queue stalls the requests when the disk can't keep up
+        self.stats = {stage: NaisStageStats() for stage in NAIS_STAGES}
+        self._write = write
+        self._queue = queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, args: tuple, on_done: callable = None, on_finish: callable = None):
+        # on_done gets the name of a written image, on_finish runs after every write, failed or not
+        self._queue.put((args, on_done, on_finish))
+
+    def flush(self):
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            args, on_done, on_finish = self._queue.get()
+            try:
+                with self.stats['write'].measure():
+                    name = self._write(*args)
+                if on_done is not None:
+                    with self.stats['notify'].measure():
+                        on_done(name)
+            except Exception as e:
+                print(e)
+            finally:
+                if on_finish is not None:
+                    on_finish()
+                self._queue.task_done()
+
+    def report(self):
+        return ' | '.join(f'{stage} {s.per_minute():.1f}/min' for stage, s in self.stats.items())
@@ -0,0 +1,117 @@
+import io
+import os
+import struct
+import zlib
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+_CHUNK = struct.Struct('>I4s')
+
+
+def _skip(f, num: int):
+    if getattr(f, 'seekable', lambda: False)():
+        f.seek(num, io.SEEK_CUR)
+    else:
+        while num > 0:
+            buf = f.read(min(num, 1 << 16))
+            if not buf:
+                break
+            num -= len(buf)
+
+
+def _decode_text(kind: bytes, body: bytes):
+    key, _, rest = body.partition(b'\0')
+    key = key.decode('latin-1')
+    if kind == b'tEXt':
+        return key, rest.decode('latin-1')
+    if kind == b'zTXt':
+        return key, zlib.decompress(rest[1:]).decode('latin-1')
+    # iTXt: compression flag, compression method, language tag, translated keyword, text
+    compressed = rest[0]
+    _, _, rest = rest[2:].partition(b'\0')
+    _, _, rest = rest.partition(b'\0')
+    if compressed:
+        rest = zlib.decompress(rest)
+    return key, rest.decode('utf-8')
+
+
+def read_png_text_stream(f):
+    # Walks the chunk headers only and stops at the first IDAT, pixel data is never read
+    if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        return None
+    info = {}
+    while True:
+        head = f.read(_CHUNK.size)
+        if len(head) < _CHUNK.size:
+            break
+        length, kind = _CHUNK.unpack(head)
+        if kind in [b'IDAT', b'IEND']:
+            break
+        if kind in [b'tEXt', b'zTXt', b'iTXt']:
+            body = f.read(length)
+            _skip(f, 4)
+            try:
+                key, value = _decode_text(kind, body)
+            except (IndexError, UnicodeDecodeError, zlib.error) as e:
+                print(e)
+                continue
+            info[key] = value
+        else:
+            _skip(f, length + 4)
+    return info
+
+
+def read_png_text(src):
+    # Accepts a path, raw bytes or a binary file object, returns None when it isn't a PNG
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return read_png_text_stream(io.BytesIO(src))
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, 'rb', buffering=1 << 12) as f:
+            return read_png_text_stream(f)
+    return read_png_text_stream(src)
+
+
+def png_text_chunk(key: str, value: str):
+    try:
+        kind, body = b'tEXt', key.encode('latin-1') + b'\0' + value.encode('latin-1')
+    except UnicodeEncodeError:
+        # Same as PIL, text outside latin-1 goes into an uncompressed iTXt chunk
+        kind, body = b'iTXt', key.encode('latin-1') + b'\0\0\0\0\0' + value.encode('utf-8')
+    return _CHUNK.pack(len(body), kind) + body + struct.pack('>I', zlib.crc32(kind + body))
+
+
+def png_with_text(data, texts: dict):
+    # Returns the file as a list of segments: IHDR, the new text chunks, the original chunks
+    # minus the replaced keys, then everything from the first IDAT on as one untouched slice
+    view = memoryview(data)
+    if bytes(view[:len(PNG_SIGNATURE)]) != PNG_SIGNATURE:
+        raise ValueError('Not a PNG image')
+    keys = {k.encode('latin-1') for k in texts}
+    pos = len(PNG_SIGNATURE)
+    length, kind = _CHUNK.unpack_from(view, pos)
+    end = pos + _CHUNK.size + length + 4
+    segments = [view[:end]] + [png_text_chunk(k, v) for k, v in texts.items()]
+    pos = end
+    while pos + _CHUNK.size <= len(view):
+        length, kind = _CHUNK.unpack_from(view, pos)
+        if kind in [b'IDAT', b'IEND']:
+            break
+        end = pos + _CHUNK.size + length + 4
+        if kind in [b'tEXt', b'zTXt', b'iTXt']:
+            body = bytes(view[pos + _CHUNK.size:pos + _CHUNK.size + min(length, 80)])
+            if body.partition(b'\0')[0] in keys:
+                pos = end
+                continue
+        segments.append(view[pos:end])
+        pos = end
+    segments.append(view[pos:])
+    return segments
+
+
+def write_png_with_text(path: str, data, texts: dict):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        for s in png_with_text(data, texts):
+            f.write(s)
+    os.replace(tmp, path)
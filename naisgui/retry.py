@@ -0,0 +1,108 @@
+import collections
+import datetime
+import email.utils
+import random
+import requests
+import threading
+
+
+NAIS_RETRY_NEVER = 0
+NAIS_RETRY_BACKOFF = 1
+NAIS_RETRY_LOGIN = 2
+
+
+class NaisError(RuntimeError):
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str):
+    # Either delta-seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class NaisJobRecord():
+    __slots__ = ('attempts', 'errors', 'ok')
+
+    def __init__(self):
+        self.attempts = 0
+        self.errors = []
+        self.ok = False
+
+
+class NaisRetryPolicy():
+    def __init__(self, attempts: int = 5, base: float = 1.0, cap: float = 60.0, history: int = 1000):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.counts = collections.Counter()
+        self._history = history
+        self._records = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def kind(e: Exception):
+        if isinstance(e, NaisError):
+            if e.status is None:
+                return 'response'
+            if e.status in [401, 429]:
+                return str(e.status)
+            return f'{e.status // 100}xx'
+        if isinstance(e, requests.exceptions.Timeout):
+            return 'timeout'
+        if isinstance(e, requests.exceptions.RequestException):
+            return 'connection'
+        return 'other'
+
+    def classify(self, e: Exception):
+        kind = self.kind(e)
+        if kind == '401':
+            return NAIS_RETRY_LOGIN
+        if kind == '4xx':
+            # The payload itself is bad, sending it again won't help
+            return NAIS_RETRY_NEVER
+        if kind == 'other':
+            return NAIS_RETRY_NEVER
+        return NAIS_RETRY_BACKOFF
+
+    def delay(self, attempt: int, e: Exception):
+        retry_after = getattr(e, 'retry_after', None)
+        if retry_after is not None:
+            return min(self.cap, retry_after) + random.uniform(0.0, self.base)
+        # Full jitter keeps parallel workers from retrying in lockstep
+        return random.uniform(0.0, min(self.cap, self.base * 2 ** attempt))
+
+    def record(self, name: str):
+        with self._lock:
+            r = self._records.get(name)
+            if r is None:
+                r = self._records[name] = NaisJobRecord()
+                if len(self._records) > self._history:
+                    self._records.popitem(last=False)
+            return r
+
+    def failed(self, record: NaisJobRecord, e: Exception):
+        kind = self.kind(e)
+        with self._lock:
+            self.counts[kind] += 1
+            record.errors.append(f'{kind}: {e}')
+
+    def report(self):
+        with self._lock:
+            return ', '.join(f'{k} x{v}' for k, v in sorted(self.counts.items()))
+
+    def job(self, name: str):
+        with self._lock:
+            return self._records.get(name)
@@ -0,0 +1,161 @@
+import copy
+import decimal
+import math
+import random
+
+
+NAIS_SWEEP_ORDERS = ['grid', 'interleaved', 'random']
+NAIS_SWEEP_OPTIONS = ['repeat', 'random_seed', 'order', 'seed']
+
+
+class NaisRange():
+    def __init__(self, fr, to, step):
+        # The i-th value is fr + i * step in decimal, so nothing accumulates and the end point is exact
+        self._float = any(isinstance(v, float) for v in (fr, to, step))
+        self._fr = decimal.Decimal(repr(fr))
+        self._step = decimal.Decimal(repr(step))
+        to = decimal.Decimal(repr(to))
+        self._len = int((to - self._fr) // self._step) + 1 if step > 0 and to >= self._fr else 0
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i: int):
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        v = self._fr + i * self._step
+        return float(v) if self._float else int(v)
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
+
+
+def nais_range(fr, to, step):
+    return NaisRange(fr, to, step)
+
+
+def nais_sweep_values(value):
+    # A list, a {"from", "to", "step"} range or a single value; repeated list entries are dropped
+    if isinstance(value, dict):
+        return nais_range(value['from'], value['to'], value['step'])
+    if isinstance(value, list):
+        values = []
+        for v in value:
+            if v not in values:
+                values.append(v)
+        return values
+    return [value]
+
+
+def _spread(n: int):
+    # A stride coprime to n near the golden section, stepping by it visits every index far from the last
+    g = max(1, int(round(n * 0.6180339887)))
+    while math.gcd(g, n) != 1:
+        g += 1
+    return g
+
+
+class NaisSweep():
+    def __init__(self, data: dict, spec: dict):
+        # Every key of the spec but the options is a parameter axis. Points are decoded from their
+        # position on demand, nothing is expanded up front:
+        #   grid        - nested loops in the spec's order, the last axis fastest
+        #   interleaved - every prefix spreads over all axes, the first len(largest axis) points
+        #                 already touch every value of every axis
+        #   random      - a seeded permutation of the grid
+        self._data = data
+        self._axes = [(k, nais_sweep_values(v)) for k, v in spec.items() if k not in NAIS_SWEEP_OPTIONS]
+        repeat = max(1, spec.get('repeat', 1))
+        self.random_seed = spec.get('random_seed', False)
+        # Without random seeds every repeat is the same payload
+        self._axes.append((None, range(repeat if self.random_seed else 1)))
+        self.order = spec.get('order', 'grid')
+        self.seed = spec.get('seed')
+        if self.seed is None:
+            self.seed = random.randrange(1 << 32)
+        self._sizes = [len(values) for _, values in self._axes]
+        self.count = math.prod(self._sizes)
+        self.dropped = self._requested(spec) * repeat - self.count
+        if self.order == 'random':
+            self._half = max(1, ((self.count - 1).bit_length() + 1) // 2)
+            self._mask = (1 << self._half) - 1
+            rng = random.Random(self.seed)
+            self._keys = [rng.getrandbits(32) for _ in range(4)]
+        if self.order == 'interleaved':
+            self._largest = sorted(range(len(self._sizes)), key=lambda d: -self._sizes[d])
+            self._strides = [_spread(n) if n else 1 for n in self._sizes]
+
+    @staticmethod
+    def _requested(spec: dict):
+        num = 1
+        for k, v in spec.items():
+            if k in NAIS_SWEEP_OPTIONS:
+                continue
+            num *= len(v) if isinstance(v, list) else len(nais_sweep_values(v))
+        return num
+
+    def __len__(self):
+        return self.count
+
+    def indices(self, k: int):
+        # Per-axis value indices of the k-th point
+        if not 0 <= k < self.count:
+            raise IndexError(k)
+        if self.order == 'interleaved':
+            idx = [0] * len(self._sizes)
+            shift = 0
+            for d in self._largest:
+                n = self._sizes[d]
+                x = (k % n + shift) % n
+                shift += k % n
+                k //= n
+                idx[d] = x * self._strides[d] % n
+            return idx
+        if self.order == 'random':
+            k = self._shuffle(k)
+        idx = []
+        for n in reversed(self._sizes):
+            idx.append(k % n)
+            k //= n
+        return idx[::-1]
+
+    def _shuffle(self, k: int):
+        # A keyed Feistel permutation of the enclosing power of four, walked until it lands inside the grid
+        while True:
+            hi, lo = k >> self._half, k & self._mask
+            for key in self._keys:
+                hi, lo = lo, hi ^ ((lo * 0x9E3779B1 ^ key) * 0x85EBCA6B >> 11 & self._mask)
+            k = hi << self._half | lo
+            if k < self.count:
+                return k
+
+    def grid_index(self, idx: list):
+        g = 0
+        for i, n in zip(idx, self._sizes):
+            g = g * n + i
+        return g
+
+    def point(self, k: int):
+        return {key: values[i] for (key, values), i in zip(self._axes, self.indices(k)) if key is not None}
+
+    def payload(self, k: int):
+        idx = self.indices(k)
+        x = copy.deepcopy(self._data)
+        for (key, values), i in zip(self._axes, idx):
+            if key is not None:
+                x['parameters'][key] = values[i]
+        if self.random_seed:
+            # Seeded by the grid position, so a resumed sweep asks for the same images
+            x['parameters']['seed'] = random.Random(f'{self.seed}:{self.grid_index(idx)}').randint(0, 4294967295)
+        return x
+
+    def __iter__(self):
+        for k in range(self.count):
+            yield self.payload(k)
+
+    def estimate(self, seconds: float, concurrency: int = 1):
+        return self.count * seconds / max(1, concurrency)
+
@@ -0,0 +1,189 @@
+import concurrent.futures
+import io
+import mmap
+import os
+import struct
+import threading
+import time
+from PIL import Image
+
+
+NAIS_THUMBNAIL_FILE = 'thumbnails.bin'
+NAIS_THUMBNAIL_MAGIC = b'NTC1'
+NAIS_THUMBNAIL_SIZE = 64
+
+# name length, png mtime, payload size; followed by the utf-8 name and the encoded thumbnail
+_RECORD = struct.Struct('<HdI')
+
+
+def make_thumbnail(im: Image.Image, size: int = NAIS_THUMBNAIL_SIZE):
+    tm = im.copy()
+    tm.thumbnail((size, size), Image.LANCZOS)
+    buf = io.BytesIO()
+    tm.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+class NaisThumbnails():
+    def __init__(self, folder: str, workers: int = 2, stats=None):
+        # All thumbnails live in one append-only pack file that is read through mmap,
+        # later records for a name shadow earlier ones until the pack is compacted
+        self._folder = folder
+        self._path = os.path.join(folder, NAIS_THUMBNAIL_FILE)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._dead = 0
+        self._map = None
+        self._pending = set()
+        self._missing = set()
+        self._listeners = []
+        self._stats = stats
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        self._open()
+
+    def _open(self):
+        if not os.path.exists(self._path) or os.path.getsize(self._path) < len(NAIS_THUMBNAIL_MAGIC):
+            with open(self._path, 'wb') as f:
+                f.write(NAIS_THUMBNAIL_MAGIC)
+        self._file = open(self._path, 'r+b')
+        if self._file.read(len(NAIS_THUMBNAIL_MAGIC)) != NAIS_THUMBNAIL_MAGIC:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(NAIS_THUMBNAIL_MAGIC)
+            self._file.flush()
+        self._scan()
+        live = sum(size for _, _, size in self._entries.values())
+        if self._dead > live and self._dead > 1 << 20:
+            self.compact()
+
+    def _scan(self):
+        self._entries = {}
+        self._dead = 0
+        self._remap()
+        if self._map is None:
+            return
+        pos = len(NAIS_THUMBNAIL_MAGIC)
+        end = len(self._map)
+        while pos + _RECORD.size <= end:
+            n, mtime, size = _RECORD.unpack_from(self._map, pos)
+            data = pos + _RECORD.size + n
+            if data + size > end:
+                # Torn write from a crash, drop the tail
+                self._map.close()
+                self._map = None
+                self._file.truncate(pos)
+                self._remap()
+                break
+            name = bytes(self._map[pos + _RECORD.size:data]).decode('utf-8')
+            old = self._entries.get(name)
+            if old is not None:
+                self._dead += old[2]
+            self._entries[name] = (mtime, data, size)
+            pos = data + size
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.flush()
+        if os.fstat(self._file.fileno()).st_size > len(NAIS_THUMBNAIL_MAGIC):
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def subscribe(self, callback: callable):
+        self._listeners.append(callback)
+
+    def get(self, name: str):
+        with self._lock:
+            e = self._entries.get(name)
+            if e is None:
+                return None
+            _, pos, size = e
+            if self._map is None or pos + size > len(self._map):
+                self._remap()
+            return self._map[pos:pos + size]
+
+    def put(self, name: str, data: bytes, mtime: float = 0.0):
+        key = name.encode('utf-8')
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            pos = self._file.tell()
+            self._file.write(_RECORD.pack(len(key), mtime, len(data)) + key + data)
+            self._file.flush()
+            old = self._entries.get(name)
+            if old is not None:
+                self._dead += old[2]
+            self._entries[name] = (mtime, pos + _RECORD.size + len(key), len(data))
+            self._missing.discard(name)
+        for callback in self._listeners:
+            callback(name)
+
+    def put_image(self, name: str, im: Image.Image, mtime: float = 0.0):
+        self.put(name, make_thumbnail(im), mtime)
+
+    def remove(self, name: str):
+        with self._lock:
+            e = self._entries.pop(name, None)
+            if e is not None:
+                self._dead += e[2]
+            self._missing.discard(name)
+
+    def request(self, name: str):
+        with self._lock:
+            if name in self._pending or name in self._missing:
+                return
+            self._pending.add(name)
+        self._pool.submit(self._generate, name)
+
+    def _generate(self, name: str):
+        t = time.monotonic()
+        try:
+            base = os.path.join(self._folder, name)
+            # Archived images only keep their legacy thumbnail around
+            for path in [base + '.png', base + '_tm.png']:
+                try:
+                    mtime = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    continue
+                with Image.open(path) as im:
+                    self.put_image(name, im, mtime)
+                if self._stats is not None:
+                    self._stats.record(time.monotonic() - t)
+                break
+            else:
+                with self._lock:
+                    self._missing.add(name)
+        except Exception as e:
+            print(name, e)
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def prune(self, mtimes: dict):
+        # Drop thumbnails whose image changed since they were made
+        with self._lock:
+            for name, mtime in mtimes.items():
+                e = self._entries.get(name)
+                if e is not None and mtime is not None and e[0] != mtime:
+                    del self._entries[name]
+                    self._dead += e[2]
+
+    def compact(self):
+        with self._lock:
+            tmp = self._path + '.tmp'
+            entries = {}
+            with open(tmp, 'wb') as f:
+                f.write(NAIS_THUMBNAIL_MAGIC)
+                for name, (mtime, pos, size) in self._entries.items():
+                    key = name.encode('utf-8')
+                    f.write(_RECORD.pack(len(key), mtime, size) + key)
+                    entries[name] = (mtime, f.tell(), size)
+                    f.write(self._map[pos:pos + size])
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._file.close()
+            os.replace(tmp, self._path)
+            self._file = open(self._path, 'r+b')
+            self._entries = entries
+            self._dead = 0
+            self._remap()
@@ -0,0 +1,206 @@
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+
+
+class _NaisClients():
+    def __init__(self, close: callable):
+        # Resizing swaps in a new client under the lock; the old one is closed once its in-flight requests
+        # are done, never under them
+        self._lock = threading.Lock()
+        self._close = close
+        self._client = None
+        self._inflight = {}
+        self._retired = set()
+
+    def current(self):
+        with self._lock:
+            return self._client
+
+    def swap(self, client):
+        with self._lock:
+            old = self._client
+            self._client = client
+            self._inflight[client] = 0
+            if old is None:
+                return
+            if self._inflight[old]:
+                self._retired.add(old)
+                return
+            del self._inflight[old]
+        self._close(old)
+
+    def acquire(self):
+        with self._lock:
+            self._inflight[self._client] += 1
+            return self._client
+
+    def release(self, client):
+        with self._lock:
+            self._inflight[client] -= 1
+            if self._inflight[client] or client not in self._retired:
+                return
+            self._retired.discard(client)
+            del self._inflight[client]
+        self._close(client)
+
+
+class NaisRequestsTransport():
+    def __init__(self, pool_size: int = 10):
+        # One keep-alive session for every worker, its pool is sized to the worker count so no connection
+        # is thrown away under load; retries are handled by Nais, never by urllib3
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._retired = 0
+        self._clients = _NaisClients(self._close)
+        self.headers = requests.utils.default_headers()
+        self.headers['Connection'] = 'keep-alive'
+        self.resize(pool_size)
+
+    def resize(self, pool_size: int):
+        # Mounting on a session other threads are posting with races its adapter lookup, so build a new one
+        session = requests.Session()
+        session.headers = self.headers
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=0, pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self._clients.swap(session)
+
+    def _close(self, session):
+        with self._lock:
+            self._retired += self._connections(session)
+        session.close()
+
+    @staticmethod
+    def _connections(session):
+        pools = session.adapters['https://'].poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def post(self, url: str, **kwargs):
+        with self._lock:
+            self._requests += 1
+        # A streamed body may still be read after release, closing the session only drops its idle connections
+        session = self._clients.acquire()
+        try:
+            return session.post(url, **kwargs)
+        finally:
+            self._clients.release(session)
+
+    def stats(self):
+        connections = self._connections(self._clients.current())
+        with self._lock:
+            return {'requests': self._requests, 'connections': self._retired + connections}
+
+
+def _httpx_error(httpx, e: Exception):
+    # Retry classification works on requests' exception types
+    if isinstance(e, httpx.TimeoutException):
+        return requests.exceptions.Timeout(e)
+    return requests.exceptions.ConnectionError(e)
+
+
+class _NaisHttpxResponse():
+    def __init__(self, httpx, stream, on_close: callable = None):
+        self._httpx = httpx
+        self._stream = stream
+        self._on_close = on_close
+        self._resp = None
+
+    def __enter__(self):
+        try:
+            self._resp = self._stream.__enter__()
+        except self._httpx.TransportError as e:
+            self._closed()
+            raise _httpx_error(self._httpx, e) from e
+        except BaseException:
+            self._closed()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        try:
+            return self._stream.__exit__(*args)
+        finally:
+            self._closed()
+
+    def _closed(self):
+        if self._on_close is not None:
+            self._on_close()
+            self._on_close = None
+
+    @property
+    def status_code(self):
+        return self._resp.status_code
+
+    @property
+    def headers(self):
+        return self._resp.headers
+
+    @property
+    def content(self):
+        return self._resp.read()
+
+    @property
+    def text(self):
+        self._resp.read()
+        return self._resp.text
+
+    def iter_content(self, chunk_size: int = None):
+        try:
+            yield from self._resp.iter_bytes(chunk_size)
+        except self._httpx.TransportError as e:
+            raise _httpx_error(self._httpx, e) from e
+
+
+class NaisHttpxTransport():
+    def __init__(self, pool_size: int = 10, http2: bool = True):
+        # Optional, needs "httpx" (and "h2" for HTTP/2); responses and errors look like requests' to Nais
+        import httpx
+        self._httpx = httpx
+        self._http2 = http2
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._clients = _NaisClients(lambda client: client.close())
+        self.headers = {}
+        self.resize(pool_size)
+
+    def resize(self, pool_size: int):
+        limits = self._httpx.Limits(max_connections=max(1, pool_size), max_keepalive_connections=max(1, pool_size))
+        self._clients.swap(self._httpx.Client(http2=self._http2, limits=limits,
+                                              event_hooks={'request': [self._on_request]}))
+
+    def _on_request(self, request):
+        with self._lock:
+            self._requests += 1
+
+    def post(self, url: str, timeout: float = None, stream: bool = False, **kwargs):
+        if isinstance(kwargs.get('data'), (str, bytes)):
+            kwargs['content'] = kwargs.pop('data')
+        # Clients are replaced on resize, so headers stay here rather than on the client
+        kwargs['headers'] = self.headers
+        client = self._clients.acquire()
+        if stream:
+            # Released when the response is closed, the body is still being read after this returns
+            return _NaisHttpxResponse(self._httpx, client.stream('POST', url, timeout=timeout, **kwargs),
+                                      lambda: self._clients.release(client))
+        try:
+            return client.post(url, timeout=timeout, **kwargs)
+        except self._httpx.TransportError as e:
+            raise _httpx_error(self._httpx, e) from e
+        finally:
+            self._clients.release(client)
+
+    def stats(self):
+        pool = getattr(self._clients.current()._transport, '_pool', None)
+        connections = len(getattr(pool, 'connections', []))
+        with self._lock:
+            return {'requests': self._requests, 'connections': connections}
+
+
+def nais_transport(name: str, pool_size: int, http2: bool = False):
+    if name == 'httpx':
+        try:
+            return NaisHttpxTransport(pool_size, http2)
+        except ImportError as e:
+            print(e, '- falling back to requests')
+    return NaisRequestsTransport(pool_size)
@@ -0,0 +1,83 @@
+import copy
+import functools
+import sys
+import threading
+import time
+from naisgui.util import json_to_text, text_to_json
+
+
+@functools.lru_cache(maxsize=32)
+def compile_tweak(script: str):
+    return compile(script, '<tweak>', 'exec')
+
+
+def run_tweak(code, data: dict, N: int, I: int, timeout: float = None):
+    # Every run gets a fresh namespace, the script may mutate or rebind data
+    ns = {'data': data, 'N': N, 'I': I}
+    if timeout is None:
+        exec(code, ns)
+        return ns['data']
+
+    # Threads can't be killed, so abort runaway scripts from a trace hook instead
+    deadline = time.monotonic() + timeout
+
+    def trace(frame, event, arg):
+        if event == 'call':
+            # Line events are not emitted for single-line loops, trace opcodes instead
+            frame.f_trace_opcodes = True
+        elif time.monotonic() > deadline:
+            raise TimeoutError(f'Tweak script timed out after {timeout} seconds')
+        return trace
+    sys.settrace(trace)
+    try:
+        exec(code, ns)
+    finally:
+        sys.settrace(None)
+    return ns['data']
+
+
+class NaisTweak():
+    def __init__(self, text: str, script: str):
+        self._data = text_to_json(text)
+        self._code = compile_tweak(script)
+
+    def render(self, N: int, I: int, timeout: float = None):
+        return run_tweak(self._code, copy.deepcopy(self._data), N, I, timeout)
+
+    def batch(self, N: int, start: int = 0):
+        for I in range(start, N):
+            yield self.render(N, I)
+
+
+class NaisTweakPreview():
+    def __init__(self, callback: callable, timeout: float = 2.0):
+        self._callback = callback
+        self._timeout = timeout
+        self._cond = threading.Condition()
+        self._request = None
+        self._revision = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str, script: str, N: int, I: int):
+        # Only the latest request is kept, anything older is dropped before or after evaluation
+        with self._cond:
+            self._revision += 1
+            self._request = (self._revision, text, script, N, I)
+            self._cond.notify()
+            return self._revision
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._request is not None)
+                rev, text, script, N, I = self._request
+                self._request = None
+            try:
+                result = json_to_text(NaisTweak(text, script).render(N, I, self._timeout))
+            except Exception as e:
+                result = str(e)
+            with self._cond:
+                if rev != self._revision:
+                    continue
+            self._callback(rev, result)
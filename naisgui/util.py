@@ -1,11 +1,9 @@
+import collections
 import json
-import os
 import subprocess
-import time
-from PySide2.QtCore import *
-from PySide2.QtGui import *
-from PySide2.QtWidgets import *
 import threading
+import time
+from hashlib import blake2b
 
 
 def read_text(path: str):
@@ -24,6 +22,11 @@ def json_to_text(obj):
     return json.dumps(obj, sort_keys=True, indent=2, ensure_ascii=False)
 
 
+def payload_digest(obj):
+    # Canonical payload hash, key order and whitespace of the source text don't matter
+    return blake2b(json_to_text(obj).encode('utf-8'), digest_size=16).hexdigest()
+
+
 def text_to_json(txt: str):
     return json.loads(txt.replace('\r', '').replace('\t', '').replace('\n', '').replace('\u3000', ' '))
 
@@ -39,149 +42,172 @@ def show_in_explorer(path: str):
         subprocess.Popen(['xdg-open', path])
 
 
-class NaisJob(QThread):
-    jobStatusChanged = Signal(int, int, str)
+class _NaisJobSource():
+    __slots__ = ('tasks', 'remaining', 'stamp')
 
-    def __init__(self):
-        super().__init__()
-        self._task = []
+    def __init__(self, tasks, num: int):
+        self.tasks = iter(tasks)
+        self.remaining = num
+        self.stamp = time.monotonic()
+
+
+class NaisJob():
+    def __init__(self, concurrency: int = 1, on_status: callable = None, on_wait: callable = None):
+        # No Qt here so the engine also runs headless, the GUI passes a signal's emit as on_status;
+        # on_wait gets the seconds each task spent queued
+        self.onStatusChanged = on_status
+        self.onWait = on_wait
+        # One FIFO per channel, channels are served round-robin so a long batch can't starve the others
+        self._task = {}
+        self._size = {}
+        self._active = collections.deque()
+        self._num = 0
         self._exit = False
-        self._canceling = False
         self._max = 0
-        self._lock = threading.Lock()
+        self._done = 0
+        self._running = 0
+        self._concurrency = max(1, concurrency)
+        # Workers by index, a worker leaves the dict itself when it retires so its index can be reused
+        self._workers = {}
+        self._cond = threading.Condition()
 
     def __del__(self):
-        self._exit = True
         self.stop()
-        self.wait()
-
-    def run(self):
-        while not self._exit:
-            if len(self._task) > 0:
-                self._lock.acquire()
-                num = len(self._task)
-                self._lock.release()
-                if num > 0:
-                    self._lock.acquire()
-                    prg = self._max - num
-                    self.jobStatusChanged.emit(prg, num, f'Processing... {prg}/{self._max}')
-                    tsk = self._task.pop(0)[1]
-                    self._lock.release()
-                    tsk()
-                if len(self._task) == 0 and not self._canceling:
-                    self.jobStatusChanged.emit(1, 1, f'Completed. {self._max}/{self._max}')
-                    self._max = 0
-            time.sleep(0.125)
-            continue
+
+    def start(self):
+        with self._cond:
+            self._exit = False
+            self._spawn_workers()
+
+    def stop(self):
+        with self._cond:
+            self._exit = True
+            self._cond.notify_all()
+            workers = list(self._workers.values())
+        for w in workers:
+            w.join()
+
+    def concurrency(self):
+        return self._concurrency
+
+    def setConcurrency(self, num: int):
+        with self._cond:
+            self._concurrency = max(1, num)
+            if self._workers:
+                self._spawn_workers()
+            self._cond.notify_all()
+
+    def _spawn_workers(self):
+        # Only free indices; a busy worker above a lowered concurrency keeps its index until it retires
+        for i in range(self._concurrency):
+            if i not in self._workers:
+                w = threading.Thread(target=self._worker, args=(i,), daemon=True)
+                self._workers[i] = w
+                w.start()
+
+    def _emit_status(self):
+        if self._num == 0 and self._running == 0:
+            self._cond.notify_all()
+            if self.onStatusChanged is not None:
+                self.onStatusChanged(1, 1, f'Completed. {self._done}/{self._max}')
+            self._max = 0
+            self._done = 0
+        elif self.onStatusChanged is not None:
+            self.onStatusChanged(self._done, self._max,
+                                 f'Processing... {self._done}/{self._max} ({self._running} running)')
+
+    def _pop(self):
+        while self._active:
+            ch = self._active.popleft()
+            queue = self._task[ch]
+            src = queue[0]
+            try:
+                tsk = next(src.tasks, None)
+            except Exception as e:
+                print(e)
+                tsk = None
+            if tsk is None:
+                # The source ran dry before its announced count
+                queue.popleft()
+                self._size[ch] -= src.remaining
+                self._num -= src.remaining
+                self._max -= src.remaining
+                if queue:
+                    self._active.append(ch)
+                continue
+            src.remaining -= 1
+            if src.remaining == 0:
+                queue.popleft()
+            if queue:
+                self._active.append(ch)
+            self._size[ch] -= 1
+            self._num -= 1
+            return tsk, src.stamp
+        return None, None
+
+    def _worker(self, index: int):
+        def retired():
+            return self._exit or index >= self._concurrency
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._num > 0 or retired())
+                if retired():
+                    del self._workers[index]
+                    return
+                tsk, stamp = self._pop()
+                if tsk is None:
+                    self._emit_status()
+                    continue
+                self._running += 1
+                self._emit_status()
+            if self.onWait is not None:
+                self.onWait(time.monotonic() - stamp)
+            try:
+                tsk()
+            except Exception as e:
+                print(e)
+            with self._cond:
+                self._running -= 1
+                self._done += 1
+                self._emit_status()
 
     def append(self, ch: int, task: callable):
-        self._lock.acquire()
-        self._task.append((ch, task))
-        num = len(self._task)
-        self._max = max(self._max, num)
-        prg = self._max - num
-        self.jobStatusChanged.emit(prg, self._max, f'Processing... {prg}/{self._max}')
-        self._lock.release()
+        self._push(ch, _NaisJobSource([task], 1), 1)
+
+    def extend(self, ch: int, tasks, num: int):
+        # Tasks are pulled from the iterable only when a worker is free, so it must not touch widgets
+        if num > 0:
+            self._push(ch, _NaisJobSource(tasks, num), num)
+
+    def _push(self, ch: int, entry, num: int):
+        with self._cond:
+            queue = self._task.get(ch)
+            if queue is None:
+                queue = self._task[ch] = collections.deque()
+                self._size[ch] = 0
+            if not queue:
+                self._active.append(ch)
+            queue.append(entry)
+            self._size[ch] += num
+            self._num += num
+            self._max += num
+            self._emit_status()
+            self._cond.notify(num)
 
     def cancel(self, ch: int):
-        self._lock.acquire()
-        self._task = [(c, task) for c, task in self._task if c != ch]
-        num = len(self._task)
-        self._max = max(self._max, num)
-        prg = self._max - num
-        self.jobStatusChanged.emit(prg, self._max, f'Processing... {prg}/{self._max}')
-        self._lock.release()
-
-
-class NaisLogin(QDialog):
-    def __init__(self):
-        super().__init__()
-        self._username = QLineEdit()
-        self._password = QLineEdit()
-        self._password.setEchoMode(QLineEdit.Password)
-        self._saveToEnv = QCheckBox()
-        layout = QFormLayout()
-        layout.addRow('Email:', self._username)
-        layout.addRow('Password:', self._password)
-        layout.addRow('Set Environment Variable', self._saveToEnv)
-        buttons = QDialogButtonBox(QDialogButtonBox.Ok)
-        buttons.accepted.connect(self.accept)
-        layout.addWidget(buttons)
-        self.setLayout(layout)
-        self.setWindowTitle('Login')
-
-    def accept(self) -> None:
-        if self._saveToEnv.isChecked():
-            if os.name == 'posix':
-                subprocess.Popen(f'export NAI_USERNAME="{self.username()}"', shell=True).wait()
-                subprocess.Popen(f'export NAI_PASSWORD="{self.password()}"', shell=True).wait()
-            if os.name == 'nt':
-                subprocess.Popen(f'setx NAI_USERNAME "{self.username()}"', shell=True).wait()
-                subprocess.Popen(f'setx NAI_PASSWORD "{self.password()}"', shell=True).wait()
-        super().accept()
-
-    def username(self):
-        return self._username.text()
-
-    def password(self):
-        return self._password.text()
-
-
-class NaisHighlighter(QSyntaxHighlighter):
-    def __init__(self, parent):
-        super().__init__(parent)
-        self.rules = []
-        # TODO:
-
-    def highlightBlock(self, text):
-        for rule in self.rules:
-            exp = QRegExp(rule.pattern)
-            index = exp.indexIn(text)
-            while index >= 0:
-                length = exp.matchedLength()
-                self.setFormat(index, length, rule.format)
-                index = text.indexOf(exp, index + length)
-        self.setCurrentBlockState(0)
-
-
-class NaisCodeEditor(QPlainTextEdit):
-    def __init__(self):
-        super().__init__()
-        f = QFont('monospace')
-        f.setStyleHint(QFont.Monospace)
-        self.setFont(f)
-        self.setLineWrapMode(QPlainTextEdit.NoWrap)
-        self._syntax = NaisHighlighter(self.document())
-
-
-class NaisImage(QLabel):
-    def __init__(self):
-        super().__init__()
-        self._pm = None
-        self.setMinimumSize(QSize(8, 8))
-        self.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
-        self.setScaledContents(False)
-        self.smoothTransformation = False
-
-    def toImagePos(self, x, y):
-        sz = self.size()
-        pm = self.pixmap().size()
-        x -= (int)(sz.width() / 2 - pm.width() / 2)
-        y -= (int)(sz.height() / 2 - pm.height() / 2)
-        ss = self._pm.size()
-        return (int((x / pm.width()) * ss.width()), int((y / pm.height()) * ss.height()))
-
-    def setImage(self, path_or_img):
-        self._pm = QPixmap(path_or_img) if path_or_img is str else QPixmap.fromImage(path_or_img).copy()
-        self.setPixmap(self._pm.scaled(
-            self.size(),
-            Qt.KeepAspectRatio,
-            Qt.SmoothTransformation if self.smoothTransformation else Qt.FastTransformation))
-
-    def resizeEvent(self, eve):
-        super().resizeEvent(eve)
-        if self._pm is not None:
-            self.setPixmap(self._pm.scaled(
-                self.size(),
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation if self.smoothTransformation else Qt.FastTransformation))
+        with self._cond:
+            queue = self._task.pop(ch, None)
+            num = self._size.pop(ch, 0)
+            if queue:
+                self._active.remove(ch)
+                self._num -= num
+                self._max -= num
+            self._emit_status()
+
+    def pending(self):
+        with self._cond:
+            return self._num
+
+    def join(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._num == 0 and self._running == 0)
@@ -0,0 +1,123 @@
+import math
+import os
+import subprocess
+import time
+from PySide2.QtCore import *
+from PySide2.QtGui import *
+from PySide2.QtWidgets import *
+
+
+class NaisLogin(QDialog):
+    def __init__(self, username: str = '', error: str = '', wait: float = 0.0):
+        super().__init__()
+        self._username = QLineEdit(username)
+        self._password = QLineEdit()
+        self._password.setEchoMode(QLineEdit.Password)
+        self._saveToEnv = QCheckBox()
+        layout = QFormLayout()
+        layout.addRow('Email:', self._username)
+        layout.addRow('Password:', self._password)
+        layout.addRow('Set Environment Variable', self._saveToEnv)
+        self._message = QLabel(error)
+        self._message.setWordWrap(True)
+        self._message.setVisible(bool(error))
+        layout.addRow(self._message)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok)
+        buttons.accepted.connect(self.accept)
+        self._ok = buttons.button(QDialogButtonBox.Ok)
+        layout.addWidget(buttons)
+        self.setLayout(layout)
+        self.setWindowTitle('Login')
+        # Back off after failed logins without blocking the event loop, the countdown is shown on the button
+        self._deadline = time.monotonic() + wait
+        self._timer = QTimer(self)
+        self._timer.setInterval(200)
+        self._timer.timeout.connect(self.on_tick)
+        self.on_tick()
+        if wait > 0.0:
+            self._timer.start()
+
+    def on_tick(self):
+        left = self._deadline - time.monotonic()
+        self._ok.setEnabled(left <= 0.0)
+        self._ok.setText(f'Retry in {math.ceil(left)} s' if left > 0.0 else 'OK')
+        if left <= 0.0:
+            self._timer.stop()
+
+    def accept(self) -> None:
+        if self._deadline > time.monotonic():
+            return
+        if self._saveToEnv.isChecked():
+            if os.name == 'posix':
+                subprocess.Popen(f'export NAI_USERNAME="{self.username()}"', shell=True).wait()
+                subprocess.Popen(f'export NAI_PASSWORD="{self.password()}"', shell=True).wait()
+            if os.name == 'nt':
+                subprocess.Popen(f'setx NAI_USERNAME "{self.username()}"', shell=True).wait()
+                subprocess.Popen(f'setx NAI_PASSWORD "{self.password()}"', shell=True).wait()
+        super().accept()
+
+    def username(self):
+        return self._username.text()
+
+    def password(self):
+        return self._password.text()
+
+
+class NaisHighlighter(QSyntaxHighlighter):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.rules = []
+        # TODO:
+
+    def highlightBlock(self, text):
+        for rule in self.rules:
+            exp = QRegExp(rule.pattern)
+            index = exp.indexIn(text)
+            while index >= 0:
+                length = exp.matchedLength()
+                self.setFormat(index, length, rule.format)
+                index = text.indexOf(exp, index + length)
+        self.setCurrentBlockState(0)
+
+
+class NaisCodeEditor(QPlainTextEdit):
+    def __init__(self):
+        super().__init__()
+        f = QFont('monospace')
+        f.setStyleHint(QFont.Monospace)
+        self.setFont(f)
+        self.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self._syntax = NaisHighlighter(self.document())
+
+
+class NaisImage(QLabel):
+    def __init__(self):
+        super().__init__()
+        self._pm = None
+        self.setMinimumSize(QSize(8, 8))
+        self.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
+        self.setScaledContents(False)
+        self.smoothTransformation = False
+
+    def toImagePos(self, x, y):
+        sz = self.size()
+        pm = self.pixmap().size()
+        x -= (int)(sz.width() / 2 - pm.width() / 2)
+        y -= (int)(sz.height() / 2 - pm.height() / 2)
+        ss = self._pm.size()
+        return (int((x / pm.width()) * ss.width()), int((y / pm.height()) * ss.height()))
+
+    def setImage(self, path_or_img):
+        self._pm = QPixmap(path_or_img) if path_or_img is str else QPixmap.fromImage(path_or_img).copy()
+        self.setPixmap(self._pm.scaled(
+            self.size(),
+            Qt.KeepAspectRatio,
+            Qt.SmoothTransformation if self.smoothTransformation else Qt.FastTransformation))
+
+    def resizeEvent(self, eve):
+        super().resizeEvent(eve)
+        if self._pm is not None:
+            self.setPixmap(self._pm.scaled(
+                self.size(),
+                Qt.KeepAspectRatio,
+                Qt.SmoothTransformation if self.smoothTransformation else Qt.FastTransformation))
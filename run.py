@@ -1,4 +1,7 @@
-from naisgui.gui import NaisGui
+import multiprocessing
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    # Imported after freeze_support so spawned worker processes never load the GUI
+    from naisgui.gui import NaisGui
     NaisGui()